@@ -0,0 +1,30 @@
+"""
+Benchmark support
+
+Helpers shared by the benchmarks: an in-memory redis for every client
+the app creates, and a count of the redis round trips made so far.
+fakeredis runs the Lua scripts with lupa, both are dev dependencies.
+"""
+
+
+def use_fakeredis() -> None:
+    """Points every redis client the app creates at one in-memory server"""
+    import fakeredis  # pylint: disable=import-outside-toplevel
+    import redis  # pylint: disable=import-outside-toplevel
+
+    server = fakeredis.FakeServer()
+
+    def from_url(cls, url, **kwargs):  # pylint: disable=unused-argument
+        pool = redis.ConnectionPool(
+            connection_class=fakeredis.FakeConnection, server=server, **kwargs
+        )
+        return cls(connection_pool=pool)
+
+    redis.Redis.from_url = classmethod(from_url)
+
+
+def redis_round_trips() -> int:
+    """Counts the redis round trips of this process so far"""
+    from service.common import metrics  # pylint: disable=import-outside-toplevel
+
+    return sum(sum(sample[:-1]) for sample in metrics.REDIS_COMMANDS.samples().values())
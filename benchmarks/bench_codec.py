@@ -0,0 +1,85 @@
+"""
+Codec benchmark
+
+Compares the user storage layouts: the legacy JSON record, the versioned
+msgpack record and the current user hash with its chat and friend sets.
+Shows stored bytes, the time to build what is written and the time to
+hydrate a User from what is read, for users with growing chat and
+friend lists. Hashes and sets are counted as their field, value and
+member bytes, redis' per-entry overhead comes on top.
+
+    python -m benchmarks.bench_codec
+"""
+import json
+import timeit
+
+from service.classes import User
+from service.common import codec
+from service.common.user_store import FIELDS, LEGACY_FIELDS
+
+SIZES = (0, 10, 100, 1000)
+ROUNDS = 2000
+
+
+def sample_user(size: int) -> dict:
+    """Builds a legacy serialized user with size chats and friends"""
+    ids = [str(140000000000000 + i) for i in range(size)]
+    return {
+        "id": "140234567890123",
+        "email": "jane@example.com",
+        "username": "janesmith",
+        "name": "Jane Smith",
+        "password": "scrypt:32768:8:1$abcdefghijklmnop$" + "0" * 128,
+        "profile_pic_link": "",
+        "chats": ids,
+        "friends": ids,
+        "pending_friends": [],
+        "sent_friends": [],
+    }
+
+
+def to_hash(data: dict) -> tuple[dict, set[str], set[str]]:
+    """Splits a legacy user into its hash, chat set and friend set"""
+    fields = {field: str(data[field]) for field in FIELDS}
+    fields["version"] = "1"
+    return fields, set(data["chats"]), set(data["friends"])
+
+
+def hash_bytes(fields: dict, *sets) -> int:
+    """Counts the field, value and member bytes of a hash and sets"""
+    size = sum(len(field) + len(value.encode()) for field, value in fields.items())
+    return size + sum(len(member) for members in sets for member in members)
+
+
+def per_call_us(statement, rounds: int = ROUNDS) -> float:
+    """Runs statement rounds times, returns microseconds per call"""
+    return timeit.timeit(statement, number=rounds) / rounds * 1e6
+
+
+def main():
+    """Prints one row per record size"""
+    legacy = LEGACY_FIELDS
+    print(f"{'size':>6} {'json B':>8} {'packed B':>8} {'hash B':>8} "
+          f"{'json enc':>9} {'pack enc':>9} {'hash enc':>9} "
+          f"{'json dec':>9} {'pack dec':>9} {'hash dec':>9}  (us)")
+    for size in SIZES:
+        data = sample_user(size)
+        as_json = json.dumps(data).encode()
+        packed = codec.encode_record(legacy, data)
+        fields, chats, friends = to_hash(data)
+        assert codec.decode_record(legacy, packed) == data
+        assert User.from_hash(fields, chats).chats == chats
+        print(
+            f"{size:>6} {len(as_json):>8} {len(packed):>8} "
+            f"{hash_bytes(fields, chats, friends):>8} "
+            f"{per_call_us(lambda: json.dumps(data).encode()):>9.2f} "
+            f"{per_call_us(lambda: codec.encode_record(legacy, data)):>9.2f} "
+            f"{per_call_us(lambda: to_hash(data)):>9.2f} "
+            f"{per_call_us(lambda: User.from_dict(json.loads(as_json))):>9.2f} "
+            f"{per_call_us(lambda: User.from_dict(codec.decode_record(legacy, packed))):>9.2f} "
+            f"{per_call_us(lambda: User.from_hash(fields, chats)):>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
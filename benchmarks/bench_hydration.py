@@ -0,0 +1,129 @@
+"""
+Hydration benchmark
+
+Compares building models from stored data through their constructors,
+which hash an empty password and draw new ids, with the from_dict
+factories. Shows the cost per request (one user) and per message, and
+for a chat with growing histories.
+
+The constructor path draws ids from redis, fakeredis unless given
+``--backend redis``, which uses REDIS_URL.
+
+    python -m benchmarks.bench_hydration [method]
+    python -m benchmarks.bench_hydration scrypt --backend redis
+"""
+import argparse
+import os
+import sys
+import timeit
+
+from benchmarks._support import use_fakeredis
+
+SIZES = (10, 100, 1000)
+# The constructor path hashes, keep it short
+SLOW_ROUNDS = 20
+FAST_ROUNDS = 2000
+
+
+def sample_user() -> dict:
+    """Builds a serialized user"""
+    return {
+        "id": "140234567890123",
+        "email": "jane@example.com",
+        "username": "janesmith",
+        "name": "Jane Smith",
+        "password": "scrypt:32768:8:1$abcdefghijklmnop$" + "0" * 128,
+        "profile_pic_link": "",
+        "chats": [str(140000000000000 + i) for i in range(20)],
+        "version": 3,
+    }
+
+
+def sample_message(i: int) -> dict:
+    """Builds a serialized message with its sender nested"""
+    return {
+        "id": str(150000000000000 + i),
+        "content": f"message {i}",
+        "edited_time": 1700000000.0 + i,
+        "sent_time": 1700000000.0 + i,
+        "user": sample_user(),
+    }
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("method", nargs="?", default="scrypt",
+                        help="password hash method of the constructor path")
+    parser.add_argument("--backend", choices=("fakeredis", "redis"), default="fakeredis")
+    return parser.parse_args(argv)
+
+
+def per_call_us(statement, rounds: int) -> float:
+    """Runs statement rounds times, returns microseconds per call"""
+    return timeit.timeit(statement, number=rounds) / rounds * 1e6
+
+
+def user_by_constructor(data: dict):
+    """The old path, User() then deserialize"""
+    from service.classes import User  # pylint: disable=import-outside-toplevel
+
+    return User().deserialize(data)
+
+
+def message_by_constructor(data: dict):
+    """The old path, a throwaway message and user per message"""
+    from service.classes import Message, User  # pylint: disable=import-outside-toplevel
+
+    message = Message(User(), "")
+    message.deserialize(data)
+    message.user = User().deserialize(data["user"])
+    return message
+
+
+def main(argv=None):
+    """Prints the per request and per message costs, then one row per history size"""
+    args = parse_args(argv)
+    os.environ["SOCKETIO_MESSAGE_QUEUE"] = ""
+    if args.backend == "fakeredis":
+        use_fakeredis()
+    # pylint: disable=import-outside-toplevel
+    from service.classes import Chat, Message, User
+    from service.common import hashing
+
+    hashing.configure(args.method)
+    user = sample_user()
+    message = sample_message(0)
+    print(f"{'':>12} {'constructor':>12} {'factory':>12}  (us)")
+    print(
+        f"{'user':>12} "
+        f"{per_call_us(lambda: user_by_constructor(user), SLOW_ROUNDS):>12.1f} "
+        f"{per_call_us(lambda: User.from_dict(user), FAST_ROUNDS):>12.1f}"
+    )
+    print(
+        f"{'message':>12} "
+        f"{per_call_us(lambda: message_by_constructor(message), SLOW_ROUNDS):>12.1f} "
+        f"{per_call_us(lambda: Message.from_dict(message), FAST_ROUNDS):>12.1f}"
+    )
+    print()
+    print(f"{'messages':>12} {'constructor':>12} {'lazy':>12} {'read all':>12}  (ms per chat)")
+    for size in SIZES:
+        chat = {
+            "id": "160000000000000",
+            "start_date": 1700000000.0,
+            "chat_name": "jane and john",
+            "members": ["140234567890123", "140234567890124"],
+            "messages": [sample_message(i) for i in range(size)],
+        }
+        # Extrapolated from 10 messages, the full history takes minutes
+        constructor = per_call_us(
+            lambda: [message_by_constructor(m) for m in chat["messages"][:10]], 1
+        ) / 10 * size
+        lazy = per_call_us(lambda: Chat.from_dict(chat), 100)
+        read_all = per_call_us(lambda: Chat.from_dict(chat).messages, 100)
+        print(f"{size:>12} {constructor / 1000:>12.2f} {lazy / 1000:>12.3f} {read_all / 1000:>12.3f}")
+    hashing.hasher.shutdown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,47 @@
+"""
+Login benchmark
+
+Measures password checks per second, the CPU cost of a login, through
+the hashing pool at growing pool sizes.
+
+    python -m benchmarks.bench_login [method]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from service.common.hashing import PasswordHasher
+
+LOGINS = 64
+# Concurrent requests, as request threads of a gthread worker
+CLIENTS = 32
+
+
+def logins_per_second(hasher: PasswordHasher, pwhash: str) -> float:
+    """Runs LOGINS password checks from CLIENTS threads"""
+    with ThreadPoolExecutor(CLIENTS) as clients:
+        start = time.perf_counter()
+        results = list(clients.map(lambda _: hasher.verify(pwhash, "hunter2"), range(LOGINS)))
+        elapsed = time.perf_counter() - start
+    assert all(results)
+    return LOGINS / elapsed
+
+
+def main():
+    """Prints one row per pool kind and size"""
+    method = sys.argv[1] if len(sys.argv) > 1 else "scrypt"
+    cores = os.cpu_count() or 1
+    print(f"method={method} cores={cores} logins={LOGINS}")
+    print(f"{'pool':>8} {'workers':>8} {'logins/s':>10} {'per core':>10}")
+    for kind in ("thread", "process"):
+        for workers in sorted({1, max(1, cores // 2), cores}):
+            hasher = PasswordHasher(method, workers, kind)
+            pwhash = hasher.hash("hunter2")
+            rate = logins_per_second(hasher, pwhash)
+            hasher.shutdown()
+            print(f"{kind:>8} {workers:>8} {rate:>10.1f} {rate / min(workers, cores):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Model benchmark
+
+Measures the model and persistence layer of service.classes at growing
+sizes: serializing and hydrating users with many chats and chats with
+long histories, pushing and pulling single objects, and loading objects
+or the new messages of many chats one round trip each against one
+batched round trip.
+
+Each row shows microseconds and redis round trips per call. fakeredis
+shows the client-side cost, a local redis-server adds the network.
+
+    python -m benchmarks.bench_models
+    python -m benchmarks.bench_models --backend redis --output models.json
+
+The redis backend writes to REDIS_URL, point it at a scratch database.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchmarks._support import redis_round_trips, use_fakeredis
+
+# Chats per user and friends per user
+SET_SIZES = (0, 10, 100, 1000)
+# Messages per chat history
+HISTORY_SIZES = (10, 100, 1000)
+# Objects per batched load
+BATCH_SIZES = (10, 100)
+# Calls per case are scaled down as sizes grow, to about this many items
+ITEMS_PER_CASE = 20000
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--backend", choices=("fakeredis", "redis"), default="fakeredis")
+    parser.add_argument("--output", help="write the rows as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def rounds_for(size: int) -> int:
+    """Gets the number of calls for a case of size items"""
+    return max(5, min(2000, ITEMS_PER_CASE // max(1, size)))
+
+
+def measure(statement, size: int) -> tuple[float, float]:
+    """Calls statement repeatedly
+
+    Returns:
+        tuple[float, float]: Microseconds and redis round trips per call
+    """
+    rounds = rounds_for(size)
+    trips = redis_round_trips()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        statement()
+    elapsed = time.perf_counter() - start
+    return elapsed / rounds * 1e6, (redis_round_trips() - trips) / rounds
+
+
+def sample_user(user_id: str, chats: int) -> dict:
+    """Builds a serialized user in the given number of chats"""
+    return {
+        "id": user_id,
+        "email": f"{user_id}@example.com",
+        "username": f"bench{user_id}",
+        "name": "Jane Smith",
+        "password": "scrypt:32768:8:1$abcdefghijklmnop$" + "0" * 128,
+        "profile_pic_link": "",
+        "chats": [str(140000000000000 + i) for i in range(chats)],
+        "version": 1,
+    }
+
+
+def sample_message(i: int, sender) -> dict:
+    """Builds a serialized message from a nested sender dict or a sender id"""
+    return {
+        "id": str(150000000000000 + i),
+        "content": f"message {i}",
+        "edited_time": 1700000000.0 + i,
+        "sent_time": 1700000000.0 + i,
+        "user": sender,
+    }
+
+
+class Report:
+    """Collects rows and prints them as they are measured"""
+
+    def __init__(self):
+        self.rows = []
+        print(f"{'group':>14} {'case':>24} {'size':>6} {'us/call':>11} {'trips':>7}")
+
+    def add(self, group: str, case: str, size: int, statement) -> None:
+        """Measures statement and prints its row"""
+        micros, trips = measure(statement, size)
+        self.rows.append(
+            {"group": group, "case": case, "size": size,
+             "us_per_call": round(micros, 2), "round_trips_per_call": round(trips, 2)}
+        )
+        print(f"{group:>14} {case:>24} {size:>6} {micros:>11.1f} {trips:>7.2f}")
+
+
+def serialization(report: Report) -> None:
+    """Serializing and hydrating, no redis involved"""
+    from service.classes import Chat, Message, User  # pylint: disable=import-outside-toplevel
+
+    for size in SET_SIZES:
+        data = sample_user("140234567890123", size)
+        user = User.from_dict(data)
+        report.add("serialize", "User.serialize", size, user.serialize)
+        report.add("serialize", "User.from_dict", size, lambda d=data: User.from_dict(d))
+    sender = sample_user("140234567890123", 20)
+    message = sample_message(0, sender)
+    report.add("serialize", "Message.from_dict", 1, lambda: Message.from_dict(message))
+    for size in HISTORY_SIZES:
+        chat = {
+            "id": "160000000000000",
+            "start_date": 1700000000.0,
+            "chat_name": "jane and john",
+            "members": ["140234567890123", "140234567890124"],
+            "messages": [sample_message(i, sender) for i in range(size)],
+        }
+        report.add("serialize", "Chat.from_dict", size, lambda c=chat: Chat.from_dict(c))
+        report.add(
+            "serialize", "Chat.from_dict+messages", size,
+            lambda c=chat: Chat.from_dict(c).messages,
+        )
+
+
+def single_objects(report: Report) -> None:
+    """Pushing and pulling one object, at growing sizes"""
+    # pylint: disable=import-outside-toplevel
+    from service.classes import User
+    from service.common import friends
+    from service.common.redis_data import r
+
+    for size in SET_SIZES:
+        user = User.from_dict(sample_user(f"9{size:014d}", size))
+        user.push_to_redis()
+        report.add("user", "push_to_redis", size, user.push_to_redis)
+        report.add("user", "User.load", size, lambda u=user: User.load(u.id))
+        key = friends.friends_key(user.id)
+        r.delete(key)
+        if size:
+            r.sadd(key, *(str(170000000000000 + i) for i in range(size)))
+        report.add("user", "friends.friends", size, lambda u=user: friends.friends(u.id))
+
+
+def batched_loads(report: Report) -> None:
+    """One round trip per object against one per batch"""
+    # pylint: disable=import-outside-toplevel
+    from service.classes import Chat, User
+    from service.common import message_log
+    from service.common.redis_data import r
+
+    for size in BATCH_SIZES:
+        users = [User.from_dict(sample_user(f"8{size:06d}{i:08d}", 20)) for i in range(size)]
+        for user in users:
+            user.push_to_redis()
+        user_ids = [user.id for user in users]
+        report.add("users", "User.load each", size, lambda ids=user_ids: [User.load(i) for i in ids])
+        report.add("users", "User.load_many", size, lambda ids=user_ids: User.load_many(ids))
+
+        chats = [Chat(user_ids[:2], f"chat {i}", []) for i in range(size)]
+        for chat in chats:
+            chat.push_to_redis()
+        chat_ids = [chat.id for chat in chats]
+        report.add("chats", "Chat.load each", size, lambda ids=chat_ids: [Chat.load(i) for i in ids])
+        report.add("chats", "Chat.load_many", size, lambda ids=chat_ids: Chat.load_many(ids))
+
+        # Ten messages per chat, read back as a reconnecting client's resume does
+        pipe = r.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            for i in range(10):
+                message_log.append(chat_id, sample_message(i, user_ids[0]), pipe)
+        pipe.execute()
+        cursors = {chat_id: "0" for chat_id in chat_ids}
+        report.add(
+            "messages", "message_log.after each", size,
+            lambda c=cursors: [message_log.after_many({k: v}) for k, v in c.items()],
+        )
+        report.add(
+            "messages", "message_log.after_many", size,
+            lambda c=cursors: message_log.after_many(c),
+        )
+
+
+def histories(report: Report) -> None:
+    """Reading the latest window and the whole history of long chats"""
+    # pylint: disable=import-outside-toplevel
+    from service.classes import Chat
+    from service.common import message_log
+    from service.common.redis_data import r
+
+    for size in HISTORY_SIZES:
+        chat = Chat.for_id(f"7{size:014d}")
+        pipe = r.pipeline(transaction=False)
+        for i in range(size):
+            message_log.append(chat.id, sample_message(i, "140234567890123"), pipe)
+        pipe.execute()
+        report.add("history", "load_messages(50)", size, chat.load_messages)
+        report.add(
+            "history", "message_log.latest(all)", size,
+            lambda c=chat, n=size: message_log.latest(c.id, n),
+        )
+
+
+def main(argv=None) -> None:
+    """Prints one row per case and size"""
+    args = parse_args(argv)
+    os.environ["SOCKETIO_MESSAGE_QUEUE"] = ""
+    if args.backend == "fakeredis":
+        use_fakeredis()
+    print(f"backend={args.backend}")
+    report = Report()
+    serialization(report)
+    single_objects(report)
+    batched_loads(report)
+    histories(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as file:
+            json.dump({"backend": args.backend, "rows": report.rows}, file, indent=2)
+            file.write("\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
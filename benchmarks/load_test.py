@@ -0,0 +1,370 @@
+"""
+Load test
+
+Drives the app in-process with simulated users: signup, login, chat
+creation, then one Socket.IO connection per user exchanging messages
+with its chat partners. Reports throughput, latency percentiles, Redis
+round trips and memory per connection, and writes them as JSON so runs
+can be compared.
+
+Connections are Flask-SocketIO test clients in this process, so the
+memory figures cover the server-side session state plus the test
+client's own bookkeeping, with no websocket or network buffers. Compare
+them between runs, not with a deployed server.
+
+    python -m benchmarks.load_test --users 1000
+    python -m benchmarks.load_test --users 1000 --output before.json
+    python -m benchmarks.load_test --users 1000 --compare before.json
+
+The default backend is fakeredis (with lupa for Lua scripts). With
+``--backend redis`` the app writes to REDIS_URL, point it at a scratch
+database or pass a new --prefix on each run.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks._support import redis_round_trips, use_fakeredis
+
+# Throughput keys where lower is worse, latency keys where higher is worse
+HIGHER_IS_BETTER = ("per_second",)
+LOWER_IS_BETTER = ("p95", "p99")
+
+# Sent over HTTP and Socket.IO alike, strong session protection hashes it
+USER_AGENT = "wesmes-load-test"
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--users", type=int, default=200, help="simulated users")
+    parser.add_argument("--concurrency", type=int, default=32, help="threads driving them")
+    parser.add_argument("--messages", type=int, default=10, help="messages sent per user")
+    parser.add_argument("--message-interval", type=float, default=0.0,
+                        help="seconds each user waits between messages")
+    parser.add_argument("--backend", choices=("fakeredis", "redis"), default="fakeredis")
+    parser.add_argument("--prefix", default="load",
+                        help="username prefix, change it to rerun against a kept database")
+    parser.add_argument("--hash-method", default="pbkdf2:sha256:1000",
+                        help="password hash method, the default keeps hashing out of the way")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="seconds to wait for deliveries")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="relative change reported as a regression")
+    return parser.parse_args(argv)
+
+
+def percentiles(seconds: list[float]) -> dict:
+    """Summarizes latencies, in milliseconds"""
+    if not seconds:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(seconds)
+
+    def rank(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        "p50": rank(0.50),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def run_phase(name: str, action, users: list, concurrency: int) -> dict:
+    """Runs action for every user from concurrency threads
+
+    Args:
+        name (str): The phase name, for progress output
+        action (Callable): Takes a user, returns True on success
+        users (list): The simulated users
+        concurrency (int): The number of threads
+
+    Returns:
+        dict: Throughput, latencies, errors and redis round trips
+    """
+    latencies = []
+
+    def timed(user):
+        start = time.perf_counter()
+        try:
+            ok = action(user)
+        except Exception as error:  # pylint: disable=broad-except
+            print(f"{name}: {error!r}", file=sys.stderr)
+            ok = False
+        latencies.append(time.perf_counter() - start)
+        return ok
+
+    trips = redis_round_trips()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed, users))
+    elapsed = time.perf_counter() - start
+    ops = len(users)
+    summary = {
+        "ops": ops,
+        "errors": results.count(False),
+        "seconds": round(elapsed, 3),
+        "per_second": round(ops / elapsed, 1) if elapsed else None,
+        "latency_ms": percentiles(latencies),
+        "redis_round_trips_per_op": round((redis_round_trips() - trips) / ops, 2) if ops else None,
+    }
+    print(f"{name:>12}: {summary['per_second']}/s, p99 {summary['latency_ms']['p99']} ms, "
+          f"{summary['errors']} errors", file=sys.stderr)
+    return summary
+
+
+class SimUser:
+    """A simulated user with its HTTP session and socket"""
+
+    def __init__(self, index: int, client, prefix: str = "load"):
+        self.index = index
+        self.username = f"{prefix}{index:06d}"
+        self.password = f"pw-{index}"
+        # A distinct address per user keeps the per-IP rate limits out of the way
+        self.ip = f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+        self.http = None
+        self.session(client)
+        self.id = None
+        self.chats = []
+        self.socket = None
+
+    @property
+    def headers(self) -> dict:
+        """Headers identifying the user's browser"""
+        return {"X-Forwarded-For": self.ip, "User-Agent": USER_AGENT}
+
+    def session(self, client) -> None:
+        """Starts a new HTTP session sending the user's headers"""
+        self.http = client
+        for name, value in self.headers.items():
+            self.http.environ_base["HTTP_" + name.upper().replace("-", "_")] = value
+
+
+class DeliveryRecorder(list):
+    """Stands in for a test client's packet list, timing chat messages as they arrive"""
+
+    def __init__(self, user: SimUser, sent_at: dict, latencies: list):
+        super().__init__()
+        self.user = user
+        self.sent_at = sent_at
+        self.latencies = latencies
+
+    def append(self, packet):
+        now = time.perf_counter()
+        if packet["name"] == "chat_message":
+            events = [["chat_message", *packet["args"]]]
+        elif packet["name"] == "batch":
+            events = packet["args"][0]
+        else:
+            return
+        for event in events:
+            if event[0] != "chat_message" or event[1].get("user") == self.user.id:
+                continue
+            sent = self.sent_at.get(event[1].get("content"))
+            if sent is not None:
+                self.latencies.append(now - sent)
+
+
+def git_commit() -> str | None:
+    """Gets the commit of the working tree, if any"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    """Runs every phase
+
+    Returns:
+        dict: The results
+    """
+    os.environ["SOCKETIO_MESSAGE_QUEUE"] = ""
+    os.environ["WESMES_PASSWORD_HASH_METHOD"] = args.hash_method
+    if args.backend == "fakeredis":
+        use_fakeredis()
+
+    # Imported here, after the redis clients are redirected
+    import service  # pylint: disable=import-outside-toplevel
+    from service.routes import app, socketio  # pylint: disable=import-outside-toplevel
+
+    service.config()
+    users = [SimUser(index, app.test_client(), args.prefix) for index in range(args.users)]
+
+    def signup(user):
+        response = user.http.post("/create_user", data={
+            "name": user.username, "email": f"{user.username}@example.com",
+            "username": user.username, "password": user.password,
+        })
+        return response.status_code == 302 and "signup" not in response.location
+
+    def login(user):
+        user.session(app.test_client())
+        response = user.http.post(
+            "/login", data={"username": user.username, "password": user.password}
+        )
+        return response.status_code == 302 and response.location.endswith("/home")
+
+    def create_chat(user):
+        partner = users[(user.index + 1) % len(users)]
+        response = user.http.post("/create_chat", data={"handle": partner.username})
+        if "/chats/" not in response.location:
+            return False
+        chat_id = response.location.rsplit("/", 1)[1]
+        user.chats.append(chat_id)
+        partner.chats.append(chat_id)
+        return True
+
+    sent_at = {}
+    latencies = []
+
+    def connect(user):
+        user.socket = socketio.test_client(
+            app, flask_test_client=user.http, headers=user.headers
+        )
+        user.socket.queue = DeliveryRecorder(user, sent_at, latencies)
+        return user.socket.is_connected()
+
+    send_latencies = []
+
+    def send(user):
+        for number in range(args.messages):
+            content = f"load:{user.index}:{number}"
+            chat_id = user.chats[number % len(user.chats)]
+            sent_at[content] = start = time.perf_counter()
+            user.socket.emit("message", {"chat_id": chat_id, "content": content})
+            send_latencies.append(time.perf_counter() - start)
+            if args.message_interval:
+                time.sleep(args.message_interval)
+        return True
+
+    phases = {
+        "signup": run_phase("signup", signup, users, args.concurrency),
+        "login": run_phase("login", login, users, args.concurrency),
+        "create_chat": run_phase("create_chat", create_chat, users, args.concurrency),
+    }
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    traced_before = tracemalloc.get_traced_memory()[0]
+    phases["connect"] = run_phase("connect", connect, users, args.concurrency)
+    traced_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    from service.common.redis_data import r  # pylint: disable=import-outside-toplevel
+
+    for user in users:
+        user.id = r.hget("usernames", user.username)
+
+    expected = args.users * args.messages
+    start = time.perf_counter()
+    phases["send"] = run_phase("send", send, users, args.concurrency)
+    deadline = time.perf_counter() + args.timeout
+    while len(latencies) < expected and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    for user in users:
+        if user.socket is not None and user.socket.is_connected():
+            user.socket.disconnect()
+
+    delivered = len(latencies)
+    return {
+        "params": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "compare", "tolerance")
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "phases": phases,
+        "messages": {
+            "sent": expected,
+            "delivered": delivered,
+            "lost": expected - delivered,
+            "per_second": round(delivered / elapsed, 1) if elapsed else None,
+            "send_ms": percentiles(send_latencies),
+            "delivery_ms": percentiles(latencies),
+        },
+        "memory": {
+            "scope": "in-process test clients, not a deployed server",
+            "test_client_per_connection_bytes": round(
+                (traced_after - traced_before) / max(1, args.users)
+            ),
+            # ru_maxrss is in KiB on Linux
+            "test_client_peak_rss_growth_kib": rss_after - rss_before,
+        },
+    }
+
+
+def _flatten(results: dict, prefix: str = "") -> dict:
+    """Maps dotted paths to the numbers in results"""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(previous: dict, current: dict, tolerance: float) -> list[str]:
+    """Lists throughputs that dropped and tail latencies that grew by more than tolerance"""
+    old = _flatten({"phases": previous["phases"], "messages": previous["messages"]})
+    new = _flatten({"phases": current["phases"], "messages": current["messages"]})
+    regressions = []
+    for path, before in old.items():
+        after = new.get(path)
+        if after is None or not before:
+            continue
+        change = (after - before) / before
+        name = path.rsplit(".", 1)[1]
+        if name in HIGHER_IS_BETTER and change < -tolerance \
+                or name in LOWER_IS_BETTER and change > tolerance:
+            regressions.append(f"{path}: {before} -> {after} ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None) -> int:
+    """Runs the load test, prints the JSON results
+
+    Returns:
+        int: 1 if a regression was found against --compare, else 0
+    """
+    args = parse_args(argv)
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as file:
+            file.write(text + "\n")
+    if args.compare:
+        with open(args.compare, encoding="utf8") as file:
+            regressions = compare(json.load(file), results, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
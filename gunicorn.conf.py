@@ -0,0 +1,20 @@
+"""
+Gunicorn configuration
+
+Production entry point:
+
+    gunicorn "service:create_app()"
+
+Flask-SocketIO keeps per-connection state in the worker process, so each
+gunicorn instance runs a single worker with a thread per connection.
+Scale out by running more instances (containers or processes); emits
+reach every instance through the Redis message queue.
+"""
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8080")
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "100"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+keepalive = 5
@@ -1,34 +1,95 @@
 """Chatting platform
 """
 
-import secrets
 import sys
 import time
-import logging
 
-from service.routes import app, login_manager
+from flask_login import user_logged_in
+
+from service.routes import app, login_manager, socketio
 from service.classes import LaunchError
-from service.common import log_handlers
+from service.common import (
+    friends,
+    hashing,
+    log_handlers,
+    message_search,
+    metrics,
+    outbound,
+    presence,
+    user_cache,
+    user_search,
+    user_store,
+)
+from service.common.config import load_config
+from service.common.sessions import (
+    RedisSessionInterface,
+    RotatingCookieSessionInterface,
+    regenerate_session,
+)
 
 def config():
     """Configures flask app
     """
-    app.config['SECRET_KEY'] = secrets.token_hex()
-    app.config['LOGGING_LEVEL'] = logging.INFO
+    load_config(app)
+    if app.config['SESSION_BACKEND'] == 'redis':
+        app.session_interface = RedisSessionInterface()
+        user_logged_in.connect(regenerate_session, app)
+    else:
+        app.session_interface = RotatingCookieSessionInterface()
+    user_cache.user_cache.maxsize = int(app.config['USER_CACHE_SIZE'])
+    user_cache.user_cache.ttl = float(app.config['USER_CACHE_TTL'])
+    user_store.migrate_on_startup()
+    user_cache.start_listener()
+    user_search.create_search_index()
+    message_search.indexer.start()
+    presence.tracker.timeout = float(app.config['PRESENCE_TIMEOUT'])
+    presence.tracker.flush_interval = float(app.config['PRESENCE_FLUSH_INTERVAL'])
+    presence.tracker.start(socketio, friends.friends_many)
+    outbound.dispatcher.window_ms = float(app.config['OUTBOUND_WINDOW_MS'])
+    outbound.dispatcher.max_queue = int(app.config['OUTBOUND_MAX_QUEUE'])
+    outbound.dispatcher.eio_high_water = int(app.config['OUTBOUND_EIO_HIGH_WATER'])
+    outbound.dispatcher.start(socketio)
+    metrics.instrument_app(app)
+    metrics.add_collector('socketio_outbound', outbound.dispatcher.stats)
+    metrics.add_collector('user_cache', user_cache.user_cache.stats)
+    metrics.add_collector(
+        'message_index', lambda: {'dropped': message_search.indexer.dropped}
+    )
+    metrics.publisher.interval = float(app.config['METRICS_PUBLISH_INTERVAL'])
+    metrics.publisher.start(socketio)
+    hashing.configure(
+        app.config['PASSWORD_HASH_METHOD'],
+        app.config['PASSWORD_HASH_WORKERS'],
+        app.config['PASSWORD_HASH_POOL'],
+        int(app.config['PASSWORD_HASH_MAX_PENDING']),
+        float(app.config['PASSWORD_HASH_TIMEOUT']),
+    )
     login_manager.init_app(app)
 
-def run():
-    """Runs server initilization
+def create_app():
+    """Configures the flask app for a production server
+
+    Used by gunicorn, see gunicorn.conf.py
+
+    Returns:
+        Flask: The configured app
     """
     with app.app_context():
         config()
-        start = time.time()
         log_handlers.init_logging(app,'gunicorn.error')
         app.logger.info(70 * "*")
         app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
+    return app
+
+def run():
+    """Runs server initilization
+    """
+    create_app()
+    with app.app_context():
+        start = time.time()
         try:
-            app.run(host='0.0.0.0', port=8080)
+            socketio.run(app, host='0.0.0.0', port=8080, allow_unsafe_werkzeug=True)
         except OSError as e:
             app.logger.error('OSError, failed to start app: %s', e)
             sys.exit()
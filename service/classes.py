@@ -1,13 +1,23 @@
 """Classes"""
 
 import time
-import json
-from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 
 
 # Redis object
-from service.common.redis_data import r
+from service.common.redis_data import r, rb
+from service.common import (
+    codec,
+    hashing,
+    ids,
+    inbox,
+    message_log,
+    message_search,
+    persistence,
+    user_cache,
+    user_search,
+    user_store,
+)
+from service.common.persistence import reserve_username
 
 
 class DataValidationError(Exception):
@@ -18,28 +28,75 @@ class LaunchError(Exception):
     """Used for an launch errors when starting the app"""
 
 
-class User(UserMixin):
+class ConflictError(Exception):
+    """Used when a user changed since it was loaded"""
+
+
+class SlottedUserMixin:
+    """What Flask-Login expects of a user, without an instance dict
+
+    flask_login.UserMixin declares no __slots__, so its subclasses get a
+    __dict__ whatever slots they declare
+    """
+
+    __slots__ = ()
+
+    # Defining __eq__ drops the default hash, keep it as UserMixin does
+    __hash__ = object.__hash__
+
+    @property
+    def is_active(self):
+        return True
+
+    @property
+    def is_authenticated(self):
+        return self.is_active
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, SlottedUserMixin):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+
+class User(SlottedUserMixin):
     """User class
 
     Derives:
-        UserMixin
+        SlottedUserMixin
     """
 
+    __slots__ = (
+        "id",
+        "email",
+        "username",
+        "name",
+        "password",
+        "profile_pic_link",
+        "chats",
+        "version",
+    )
+
     def __init__(
         self, name="", email="", password="", username="", profile_pic_link=""
     ):
-        self.id = str(id(self))
+        self.id = ids.new_id()
         self.name = str(name)
         self.email = str(email)
-        self.password = generate_password_hash(password)
+        self.password = hashing.hash_password(password)
         self.username = str(username)
         self.profile_pic_link = str(
             profile_pic_link
         )  # TODO: Create place to store profile pics
-        self.chats = [str]  # Pointer to the the chat_id
-        self.friends = [str]  # Pointer to friend's user_id
-        self.pending_friends = [str]  # Pointer to friend's user_id
-        self.sent_friends = [str]  # Pointer to friend's user_id
+        self.chats: set[str] = set()  # Pointer to the the chat_id
+        # Friends live in redis sets, see service.common.friends
+        self.version = 0  # Bumped by every write, see user_store
 
     def check_password(self, password: str) -> bool:
         """Checks Password
@@ -50,33 +107,154 @@ class User(UserMixin):
         Returns:
             bool: If the password is correct
         """
-        return check_password_hash(self.password, password)
+        return hashing.verify_password(self.password, password)
+
+    def upgrade_password(self, password: str) -> bool:
+        """Rehashes the password if the hashing parameters changed
+
+        Call after a successful check_password, while the plain password is known
+
+        Args:
+            password (str): The un-hashed password
+
+        Returns:
+            bool: If the hash was replaced, the caller should update the user
+        """
+        if not hashing.needs_rehash(self.password):
+            return False
+        self.password = hashing.hash_password(password)
+        return True
 
     def get_id(self):
         return self.id
 
-    def push_to_redis(self):
-        """Pushes self to redis"""
-        # r.hset(f"users:{self.id}", mapping=self.serialize())
-        serialized_data = json.dumps(self.serialize())
-        r.set(f"users:{self.id}", serialized_data)
+    @classmethod
+    def from_dict(cls, data: dict) -> "User":
+        """Builds a user from serialized data without hashing a password
+
+        Args:
+            data (dict): A dictionary containing the resource data
+
+        Returns:
+            User: The user
+        """
+        return cls.__new__(cls).deserialize(data)
+
+    @classmethod
+    def from_hash(cls, fields: dict, chats) -> "User":
+        """Builds a user from its stored hash and chat set"""
+        return cls.from_dict({**fields, "chats": chats})
+
+    @classmethod
+    def load(cls, user_id: str) -> "User | None":
+        """Loads a user
+
+        Args:
+            user_id (str): The id of the user
+
+        Returns:
+            User: The user, or None if it does not exist
+        """
+        if user_id is None:
+            return None
+        stored = user_store.load_many([user_id])[0]
+        return None if stored is None else cls.from_hash(*stored)
+
+    def _fields(self) -> dict:
+        """Gets the scalar fields stored in the user hash"""
+        return {field: getattr(self, field) for field in user_store.FIELDS}
+
+    def create(self) -> bool:
+        """Reserves the username and pushes self to redis in one step
+
+        Returns:
+            bool: False if the username is already taken
+        """
+        self.version = 1
+        if not reserve_username(
+            self.username,
+            self.id,
+            user_store.user_key(self.id),
+            {**self._fields(), "version": self.version},
+        ):
+            return False
+        user_search.index_username(self.username, self.id)
+        return True
+
+    def push_to_redis(self, client=None):
+        """Pushes every field of self to redis, without a version check
+
+        Chats are added to the stored ones, never removed. Queued on a
+        pipeline, the new version is only known to the pipeline's caller.
+
+        Args:
+            client (Redis, optional): Client or pipeline to queue the writes on
+        """
+        version = user_store.write(self.id, self._fields(), self.chats, client)
+        if client is None:
+            self.version = version
+        user_cache.invalidate(self.id, client)
+
+    def update(self, **fields) -> None:
+        """Writes only the given fields, if self is not stale
+
+        Args:
+            **fields: Field names and their new values
+
+        Raises:
+            ConflictError: Someone else changed the user since it was loaded
+        """
+        unknown = set(fields) - set(user_store.FIELDS)
+        if unknown:
+            raise DataValidationError("Invalid User fields: " + ", ".join(sorted(unknown)))
+        version = user_store.update(self.id, fields, self.version)
+        if version is None:
+            raise ConflictError(f"User {self.id} changed since version {self.version}")
+        for field, value in fields.items():
+            setattr(self, field, value)
+        self.version = version
+        user_cache.invalidate(self.id)
+
+    def add_chat(self, chat_id: str, client=None) -> None:
+        """Adds a chat to self, safe against concurrent writers
+
+        Args:
+            chat_id (str): The id of the chat
+            client (Redis, optional): Client or pipeline to queue the writes on
+        """
+        self.chats.add(chat_id)
+        user_store.add_chat(self.id, chat_id, client)
+        user_cache.invalidate(self.id, client)
 
     def pull_from_redis(self, current_id):
-        """Pulls self from redis"""
-        # self.id = r.hget(f"users:{current_id}", "id")
-        # self.name = r.hget(f"users:{current_id}", "name")
-        # self.email = r.hget(f"users:{current_id}", "email")
-        # self.password = r.hget(f"users:{current_id}", "password")
-        # self.username = r.hget(f"users:{current_id}", "username")
-        # self.profile_pic_link = r.hget(f"users:{current_id}", "profile_pic_link")
-        # self.chats = json.loads(r.hget(f"users:{current_id}", "chats"))
-        # self.friends = json.loads(r.hget(f"users:{current_id}", "friends"))
-        # self.pending_friends = json.loads(r.hget(f"users:{current_id}", "pending_friends"))
-        # self.sent_friends = json.loads(r.hget(f"users:{current_id}", "sent_friends"))
-        data = r.get(f"users:{current_id}")
-
-        if data:
-            self.deserialize(json.loads(data))
+        """Pulls self from redis
+
+        Returns:
+            User: self, or None if the user does not exist
+        """
+        if current_id is None:
+            return None
+        stored = user_store.load_many([current_id])[0]
+        if stored is None:
+            return None
+        fields, chats = stored
+        return self.deserialize({**fields, "chats": chats})
+
+    @classmethod
+    def load_many(cls, ids: list[str]) -> list["User"]:
+        """Loads several users in one round trip
+
+        Args:
+            ids (list[str]): The ids of the users
+
+        Returns:
+            list[User]: The users that exist, in the order of ids
+        """
+        if not ids:
+            return []
+        return [
+            cls.from_hash(*stored) for stored in user_store.load_many(ids) if stored is not None
+        ]
 
     ################################
     # SERIALIZE/DESERIALIZE ########
@@ -95,10 +273,8 @@ class User(UserMixin):
             "name": self.name,
             "password": self.password,
             "profile_pic_link": self.profile_pic_link,
-            "chats": self.chats,
-            "friends": self.friends,
-            "pending_friends": self.pending_friends,
-            "sent_friends": self.sent_friends,
+            "chats": sorted(self.chats),
+            "version": self.version,
         }
         return result
 
@@ -116,10 +292,9 @@ class User(UserMixin):
             self.name = data["name"]
             self.password = data["password"]
             self.email = data["email"]
-            self.chats = data["chats"]
-            self.friends = data["friends"]
-            self.pending_friends = data["pending_friends"]
-            self.sent_friends = data["sent_friends"]
+            # Old records held other values next to the chat ids
+            self.chats = {chat_id for chat_id in data["chats"] if isinstance(chat_id, str)}
+            self.version = int(data.get("version", 0))
 
         except AttributeError as error:
             raise DataValidationError("Invalid attribute: " + error.args[0]) from error
@@ -127,7 +302,7 @@ class User(UserMixin):
             raise DataValidationError(
                 "Invalid User: missing " + error.args[0]
             ) from error
-        except TypeError as error:
+        except (TypeError, ValueError) as error:
             raise DataValidationError(
                 "Invalid User: body of request contained bad or no data " + str(error)
             ) from error
@@ -135,9 +310,14 @@ class User(UserMixin):
 
 
 class Message:
-    """Message class"""
+    """Message class
+
+    Messages are stored in their chat's stream, see message_log
+    """
+
+    __slots__ = ("id", "user", "content", "edited_time", "sent_time", "_sender")
 
-    def __init__(self, user: str, content: str, sent_time: float = time.time()):
+    def __init__(self, user: str, content: str, sent_time: float | None = None):
         """The constructor
 
         Args:
@@ -145,33 +325,43 @@ class Message:
             content (str): The message content
             sent_time (float, optional): The time sent. Defaults to time.time().
         """
-        self.id = str(id(self))
+        if sent_time is None:
+            sent_time = time.time()
+        self.id = ids.new_id()
         self.user = user
         self.content = content
         self.edited_time = sent_time
         self.sent_time = sent_time
+        self._sender = None
 
     def get_id(self):
         """Gets id"""
         return self.id
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Message":
+        """Builds a message from serialized data without drawing a new id"""
+        return cls.__new__(cls).deserialize(data)
+
+    @property
+    def sender(self) -> "User | None":
+        """The user who sent the message, built on first access
+
+        ``user`` holds the sender's id, or their serialized data when the
+        message was deserialized with the user nested in it
+        """
+        if self._sender is None and self.user:
+            if isinstance(self.user, dict):
+                self._sender = User.from_dict(self.user)
+            else:
+                self._sender = User.load(str(self.user))
+        return self._sender
+
     def update_message(self, new_message: str):
         """Updates message content"""
         self.content = new_message
         self.edited_time = time.time()
 
-    def push_to_redis(self):
-        """Pushes self to redis"""
-        r.hset(f"messages:{self.id}", mapping=self.serialize())
-
-    def pull_from_redis(self, chat_id):
-        """Pulls self from redis"""
-        self.id = r.hget(f"messages:{chat_id}", "id")
-        self.user = r.hget(f"messages:{chat_id}", "user")
-        self.content = r.hget(f"messages:{chat_id}", "content")
-        self.edited_time = r.hget(f"messages:{chat_id}", "edited_time")
-        self.sent_time = r.hget(f"messages:{chat_id}", "sent_time")
-
     ################################
     # SERIALIZE/DESERIALIZE ########
     ################################
@@ -203,7 +393,9 @@ class Message:
             self.content = data["content"]
             self.edited_time = data["edited_time"]
             self.sent_time = data["sent_time"]
-            self.user = User().deserialize(data["user"])
+            # A nested user is only built when sender is read
+            self.user = data["user"]
+            self._sender = None
         except AttributeError as error:
             raise DataValidationError("Invalid attribute: " + error.args[0]) from error
         except KeyError as error:
@@ -220,12 +412,14 @@ class Message:
 class Chat:
     """The chat class"""
 
+    __slots__ = ("id", "members", "start_date", "_messages", "_raw_messages", "chat_name")
+
     def __init__(
         self,
         members: list[str],
         chat_name: str,
         messages: list[str],
-        start_date: float = time.time(),
+        start_date: float | None = None,
     ):
         """The constructor
 
@@ -235,7 +429,9 @@ class Chat:
             messages (list[Message]): The array of messages
             start_date (float, optional): The time the chat was created. Defaults to time.time().
         """
-        self.id = str(id(self))
+        if start_date is None:
+            start_date = time.time()
+        self.id = ids.new_id()
         self.members = members
         self.start_date = start_date
         self.messages = messages
@@ -245,17 +441,144 @@ class Chat:
         """Gets id"""
         return self.id
 
-    def push_to_redis(self):
-        """Pushes self to redis"""
-        r.hset(f"chats:{self.id}", mapping=self.serialize())
+    @property
+    def messages(self) -> list:
+        """The chat's messages, deserialized ones are built on first access"""
+        if self._raw_messages is not None:
+            self._messages = [Message.from_dict(message) for message in self._raw_messages]
+            self._raw_messages = None
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages: list):
+        self._messages = messages
+        self._raw_messages = None
+
+    @classmethod
+    def for_id(cls, chat_id: str) -> "Chat":
+        """Gets a chat known only by its id
+
+        Enough to append messages and read history without loading the chat
+
+        Args:
+            chat_id (str): The id of the chat
+
+        Returns:
+            Chat: The chat, with no members or name
+        """
+        chat = cls.__new__(cls)
+        chat.id = chat_id
+        chat.members = []
+        chat.start_date = None
+        chat.chat_name = ""
+        chat.messages = []
+        return chat
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Chat":
+        """Builds a chat from serialized data without drawing a new id"""
+        return cls.for_id(None).deserialize(data)
+
+    @classmethod
+    def from_hash(cls, data: dict) -> "Chat":
+        """Builds a chat from its stored hash read as bytes"""
+        return cls.__new__(cls)._load_hash(data)
+
+    @classmethod
+    def load(cls, chat_id: str) -> "Chat | None":
+        """Loads a chat, without its messages
+
+        Returns:
+            Chat: The chat, or None if it does not exist
+        """
+        data = rb.hgetall(f"chats:{chat_id}")
+        return cls.from_hash(data) if data else None
+
+    def push_to_redis(self, client=None):
+        """Pushes self to redis
+
+        Args:
+            client (Redis, optional): Client or pipeline to queue the write on
+        """
+        client = r if client is None else client
+        client.hset(f"chats:{self.id}", mapping=self._to_hash())
+        inbox.add_chat(self.id, self.members, float(self.start_date), client)
+
+    def pull_from_redis(self, chat_id):
+        """Pulls self from redis
+
+        Messages live in the chat's stream, see ``load_messages``
+
+        Returns:
+            Chat: self, or None if the chat does not exist
+        """
+        data = rb.hgetall(f"chats:{chat_id}")
+        if not data:
+            return None
+        return self._load_hash(data)
 
-    def pull_from_redis(self, message_id):
-        """Pulls self from redis"""
-        self.id = r.hget(f"chats:{message_id}", "id")
-        self.members = json.loads(r.hget(f"chats:{message_id}", "members"))
-        self.start_date = r.hget(f"chats:{message_id}", "start_date")
-        self.messages = json.loads(r.hget(f"chats:{message_id}", "messages"))
-        self.chat_name = r.hget(f"chats:{message_id}", "chat_name")
+    @classmethod
+    def load_many(cls, ids: list[str]) -> list["Chat"]:
+        """Loads several chats in one round trip
+
+        Args:
+            ids (list[str]): The ids of the chats
+
+        Returns:
+            list[Chat]: The chats that exist, in the order of ids
+        """
+        pipe = rb.pipeline(transaction=False)
+        for chat_id in ids:
+            pipe.hgetall(f"chats:{chat_id}")
+        return [cls.from_hash(data) for data in pipe.execute() if data]
+
+    def _to_hash(self) -> dict:
+        """Gets the fields of the stored hash"""
+        return {
+            "id": self.id,
+            "members": codec.encode(self.members),
+            "start_date": self.start_date,
+            "chat_name": self.chat_name,
+        }
+
+    def _load_hash(self, data: dict):
+        """Sets fields from a stored hash read as bytes"""
+        members = data.get(b"members")
+        self.id = data[b"id"].decode()
+        self.members = codec.decode(members) if members else []
+        self.start_date = data[b"start_date"].decode()
+        self.messages = []
+        self.chat_name = data[b"chat_name"].decode()
+        return self
+
+    def append_message(self, message: "Message") -> tuple[str, int]:
+        """Appends a message to the chat's log and the members' inboxes
+
+        Args:
+            message (Message): The message to append
+
+        Returns:
+            tuple[str, int]: The stream entry id of the message and its seq
+        """
+        self.messages.append(message)
+        serialized = message.serialize()
+        cursor, seq = persistence.append_message(self.id, serialized)
+        message_search.indexer.enqueue(self.id, serialized, cursor)
+        return cursor, seq
+
+    def load_messages(self, cursor: str | None = None, limit: int = 50) -> list[dict]:
+        """Loads a window of the chat's history
+
+        Args:
+            cursor (str, optional): Only load messages older than this entry id
+            limit (int, optional): Max number of messages. Defaults to 50.
+
+        Returns:
+            list[dict]: The serialized messages, oldest first
+        """
+        if cursor is None:
+            return message_log.latest(self.id, limit)
+        return message_log.before(self.id, cursor, limit)
 
     ################################
     # SERIALIZE/DESERIALIZE ########
@@ -269,8 +592,7 @@ class Chat:
         """
         result = {
             "id": self.id,
-            "members": json.dumps(self.members),
-            "messages": json.dumps(self.messages),
+            "members": self.members,
             "start_date": self.start_date,
             "chat_name": self.chat_name,
         }
@@ -287,14 +609,12 @@ class Chat:
             self.id = data["id"]
             self.start_date = data["start_date"]
             self.chat_name = data["chat_name"]
-            for message in data["messages"]:
-                new_message = Message(User(), "")
-                new_message.deserialize(message)
-                self.messages.append(new_message)
-            for member in data["members"]:
-                new_user = User()
-                new_user.deserialize(member)
-                self.messages.append(new_user)
+            # Messages are only built when messages is read
+            self._raw_messages = list(data.get("messages") or [])
+            self.members = [
+                member["id"] if isinstance(member, dict) else member
+                for member in data["members"]
+            ]
         except AttributeError as error:
             raise DataValidationError("Invalid attribute: " + error.args[0]) from error
         except KeyError as error:
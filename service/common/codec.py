@@ -0,0 +1,82 @@
+"""
+Codec
+
+Compact storage format for models. Records are a schema version byte
+followed by msgpack, with fields stored positionally instead of by
+name. Records written before versioning (JSON) are still decoded and
+get rewritten in the new format on their next save.
+"""
+import json
+
+import msgpack
+
+# Bump when the field order of a record changes
+SCHEMA_VERSION = 1
+
+_VERSION_BYTE = bytes([SCHEMA_VERSION])
+_LEGACY_PREFIXES = (b"{", b"[", b'"')
+
+
+def _as_bytes(raw) -> bytes:
+    return raw.encode() if isinstance(raw, str) else raw
+
+
+def encode(value) -> bytes:
+    """Encodes a plain value (list, dict, str, number)
+
+    Args:
+        value: The value
+
+    Returns:
+        bytes: The versioned encoding
+    """
+    return _VERSION_BYTE + msgpack.packb(value, use_bin_type=True)
+
+
+def decode(raw):
+    """Decodes a value written by encode, or legacy JSON
+
+    Args:
+        raw (bytes): The stored value
+
+    Raises:
+        ValueError: The value has an unknown format
+
+    Returns:
+        The decoded value
+    """
+    raw = _as_bytes(raw)
+    if raw[:1] in _LEGACY_PREFIXES:
+        return json.loads(raw)
+    if raw[:1] == _VERSION_BYTE:
+        return msgpack.unpackb(raw[1:], raw=False)
+    raise ValueError(f"Unknown record version {raw[:1]!r}")
+
+
+def encode_record(fields: tuple, data: dict) -> bytes:
+    """Encodes a record with a fixed field order
+
+    Args:
+        fields (tuple): The field names, in storage order
+        data (dict): The serialized object
+
+    Returns:
+        bytes: The versioned encoding
+    """
+    return encode([data[field] for field in fields])
+
+
+def decode_record(fields: tuple, raw) -> dict:
+    """Decodes a record written by encode_record, or a legacy JSON object
+
+    Args:
+        fields (tuple): The field names, in storage order
+        raw (bytes): The stored record
+
+    Returns:
+        dict: The serialized object
+    """
+    value = decode(raw)
+    if isinstance(value, dict):
+        return value
+    return dict(zip(fields, value))
@@ -0,0 +1,120 @@
+"""
+Config
+
+Loads app settings from defaults, an optional config file and the
+environment, in that order. The secret key is stable across workers
+and restarts so sessions stay valid.
+"""
+import json
+import logging
+import os
+import secrets
+import tomllib
+
+from service.common.redis_data import r
+
+# Prefix of environment overrides, e.g. WESMES_SESSION_BACKEND=redis
+ENV_PREFIX = "WESMES"
+
+# Redis key of the generated secret key shared by every worker
+SHARED_SECRET_KEY = "config:secret_key"
+
+DEFAULTS = {
+    "LOGGING_LEVEL": logging.INFO,
+    "LOGGING_FORMAT": "json",
+    "LOGGING_QUEUE_SIZE": 10000,
+    "ACCESS_LOG_SAMPLE_RATE": 1.0,
+    "ACCESS_LOG_SAMPLE_RATES": {"static": 0.1, "unmatched": 0.1},
+    "ACCESS_LOG_RATE_CAP": 100,
+    "SECRET_KEY": None,
+    "SECRET_KEY_FALLBACKS": [],
+    "SESSION_BACKEND": "cookie",
+    "SESSION_REDIS_TTL": 86400,
+    "USER_CACHE_SIZE": 1024,
+    "USER_CACHE_TTL": 30.0,
+    "PASSWORD_HASH_METHOD": "scrypt",
+    "PASSWORD_HASH_POOL": "thread",
+    "PASSWORD_HASH_WORKERS": None,
+    "PASSWORD_HASH_MAX_PENDING": 256,
+    "PASSWORD_HASH_TIMEOUT": 5.0,
+    "PRESENCE_TIMEOUT": 60,
+    "PRESENCE_FLUSH_INTERVAL": 2,
+    "OUTBOUND_WINDOW_MS": 20,
+    "OUTBOUND_MAX_QUEUE": 256,
+    "OUTBOUND_EIO_HIGH_WATER": 64,
+    "METRICS_PUBLISH_INTERVAL": 10,
+}
+
+
+def _read_file(path: str) -> str:
+    with open(path, encoding="utf8") as file:
+        return file.read().strip()
+
+
+def load_file(app, path: str) -> None:
+    """Loads settings from a TOML or JSON file
+
+    Args:
+        app (Flask): The app
+        path (str): The path of the file
+    """
+    if path.endswith(".toml"):
+        app.config.from_file(path, load=tomllib.load, text=False)
+    else:
+        app.config.from_file(path, load=json.load)
+
+
+def resolve_secret_key(app) -> str:
+    """Finds the secret key
+
+    Uses, in order: SECRET_KEY from the file or environment, the contents of
+    SECRET_KEY_FILE, or a key generated once and shared through redis.
+
+    Args:
+        app (Flask): The app
+
+    Returns:
+        str: The secret key
+    """
+    key = app.config.get("SECRET_KEY") or os.getenv("SECRET_KEY")
+    if key:
+        return key
+    key_file = app.config.get("SECRET_KEY_FILE") or os.getenv("SECRET_KEY_FILE")
+    if key_file:
+        return _read_file(key_file)
+    r.set(SHARED_SECRET_KEY, secrets.token_hex(), nx=True)
+    return r.get(SHARED_SECRET_KEY)
+
+
+def resolve_fallbacks(app) -> list[str]:
+    """Finds the old secret keys still accepted for verification
+
+    SECRET_KEY_FALLBACKS may be a list or a comma separated string.
+
+    Args:
+        app (Flask): The app
+
+    Returns:
+        list[str]: The old keys, oldest first
+    """
+    fallbacks = app.config.get("SECRET_KEY_FALLBACKS") or os.getenv(
+        "SECRET_KEY_FALLBACKS", ""
+    )
+    if isinstance(fallbacks, str):
+        fallbacks = fallbacks.split(",")
+    return [key.strip() for key in fallbacks if key and key.strip()]
+
+
+def load_config(app) -> None:
+    """Loads every setting into app.config
+
+    Args:
+        app (Flask): The app
+    """
+    app.config.update(DEFAULTS)
+    config_file = os.getenv(f"{ENV_PREFIX}_CONFIG")
+    if config_file:
+        load_file(app, config_file)
+    app.config.from_prefixed_env(ENV_PREFIX)
+    app.config["SECRET_KEY"] = resolve_secret_key(app)
+    app.config["SECRET_KEY_FALLBACKS"] = resolve_fallbacks(app)
@@ -0,0 +1,62 @@
+"""
+Delivery
+
+Client acks and reconnect catch-up. Clients ack the cursor of the last
+message they saw in each chat; after a reconnect they resume from it
+and are sent only the messages they missed.
+
+    acks:{user_id}  hash, chat id -> cursor of the last acked message
+"""
+from service.common import message_log
+from service.common.redis_data import r
+
+# Max messages replayed per chat, clients reload history past that
+REPLAY_LIMIT = 200
+
+
+def ack(user_id: str, chat_id: str, cursor: str) -> None:
+    """Records the last message of a chat a user received
+
+    Args:
+        user_id (str): The id of the user
+        chat_id (str): The id of the chat
+        cursor (str): The cursor of the message
+    """
+    if message_log.is_cursor(cursor):
+        r.hset(f"acks:{user_id}", chat_id, cursor)
+
+
+def replay(user_id: str, chat_ids: list[str], cursors: dict | None = None,
+           limit: int = REPLAY_LIMIT) -> dict:
+    """Gets the messages a user missed, in one round trip per call
+
+    Cursors sent by the client win over the stored acks; chats with
+    neither are skipped.
+
+    Args:
+        user_id (str): The id of the user
+        chat_ids (list[str]): The chats to catch up on, only the ones the
+            client shows, since each may replay up to limit messages
+        cursors (dict, optional): chat id -> last cursor the client has
+        limit (int, optional): Max messages per chat. Defaults to REPLAY_LIMIT.
+
+    Returns:
+        dict: chat id -> {"messages": [...], "complete": bool}
+    """
+    cursors = cursors or {}
+    if not chat_ids:
+        return {}
+    stored = r.hmget(f"acks:{user_id}", chat_ids)
+    resume_from = {}
+    for chat_id, acked in zip(chat_ids, stored):
+        cursor = cursors.get(chat_id)
+        cursor = cursor if message_log.is_cursor(cursor) else acked
+        if cursor:
+            resume_from[chat_id] = cursor
+    if not resume_from:
+        return {}
+    missed = message_log.after_many(resume_from, limit)
+    return {
+        chat_id: {"messages": messages, "complete": len(messages) < limit}
+        for chat_id, messages in missed.items()
+    }
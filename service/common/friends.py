@@ -0,0 +1,273 @@
+"""
+Friends
+
+The friend graph, stored as Redis sets instead of lists in the user
+record:
+
+    friends:{user_id}          set of friend ids
+    friends:{user_id}:pending  set of ids who sent the user a request
+    friends:{user_id}:sent     set of ids the user sent a request to
+
+Requests, accepts and declines touch both users' sets in one Lua
+script, and each costs O(1) however many friends the users have.
+"""
+from collections import Counter
+
+from service.common import codec
+from service.common.redis_data import r, rb
+from service.common.user_store import LEGACY_FIELDS
+
+# Friends sampled, and friends of each sampled, when suggesting friends
+SUGGESTION_SAMPLE = 20
+SUGGESTION_FANOUT = 50
+
+# KEYS: sender friends, sender pending, sender sent,
+#       receiver friends, receiver pending, receiver sent
+# ARGV: sender id, receiver id
+_REQUEST = r.register_script(
+    """
+    if redis.call('SISMEMBER', KEYS[1], ARGV[2]) == 1 then
+        return 'friends'
+    end
+    if redis.call('SREM', KEYS[2], ARGV[2]) == 1 then
+        redis.call('SREM', KEYS[6], ARGV[1])
+        redis.call('SADD', KEYS[1], ARGV[2])
+        redis.call('SADD', KEYS[4], ARGV[1])
+        return 'accepted'
+    end
+    if redis.call('SADD', KEYS[3], ARGV[2]) == 0 then
+        return 'pending'
+    end
+    redis.call('SADD', KEYS[5], ARGV[1])
+    return 'sent'
+    """
+)
+
+# KEYS: user friends, user pending, requester friends, requester sent
+# ARGV: user id, requester id
+_ACCEPT = r.register_script(
+    """
+    if redis.call('SREM', KEYS[2], ARGV[2]) == 0 then
+        return 0
+    end
+    redis.call('SREM', KEYS[4], ARGV[1])
+    redis.call('SADD', KEYS[1], ARGV[2])
+    redis.call('SADD', KEYS[3], ARGV[1])
+    return 1
+    """
+)
+
+# KEYS: user pending, requester sent
+# ARGV: user id, requester id
+_DECLINE = r.register_script(
+    """
+    redis.call('SREM', KEYS[2], ARGV[1])
+    return redis.call('SREM', KEYS[1], ARGV[2])
+    """
+)
+
+
+def friends_key(user_id: str) -> str:
+    """Gets the key of a user's friend set"""
+    return f"friends:{user_id}"
+
+
+def pending_key(user_id: str) -> str:
+    """Gets the key of a user's received requests"""
+    return f"friends:{user_id}:pending"
+
+
+def sent_key(user_id: str) -> str:
+    """Gets the key of a user's sent requests"""
+    return f"friends:{user_id}:sent"
+
+
+def request(sender_id: str, receiver_id: str) -> str:
+    """Sends a friend request, accepting one going the other way
+
+    Args:
+        sender_id (str): The id of the user sending the request
+        receiver_id (str): The id of the user receiving it
+
+    Returns:
+        str: sent, pending if already sent, accepted if the receiver had
+            sent one too, friends if they already are, or self
+    """
+    if sender_id == receiver_id:
+        return "self"
+    return _REQUEST(
+        keys=[
+            friends_key(sender_id),
+            pending_key(sender_id),
+            sent_key(sender_id),
+            friends_key(receiver_id),
+            pending_key(receiver_id),
+            sent_key(receiver_id),
+        ],
+        args=[sender_id, receiver_id],
+    )
+
+
+def accept(user_id: str, requester_id: str) -> bool:
+    """Accepts a friend request
+
+    Args:
+        user_id (str): The id of the user who received the request
+        requester_id (str): The id of the user who sent it
+
+    Returns:
+        bool: False if there was no such request
+    """
+    return bool(
+        _ACCEPT(
+            keys=[
+                friends_key(user_id),
+                pending_key(user_id),
+                friends_key(requester_id),
+                sent_key(requester_id),
+            ],
+            args=[user_id, requester_id],
+        )
+    )
+
+
+def decline(user_id: str, requester_id: str) -> bool:
+    """Declines a friend request
+
+    Args:
+        user_id (str): The id of the user who received the request
+        requester_id (str): The id of the user who sent it
+
+    Returns:
+        bool: False if there was no such request
+    """
+    return bool(
+        _DECLINE(
+            keys=[pending_key(user_id), sent_key(requester_id)],
+            args=[user_id, requester_id],
+        )
+    )
+
+
+def remove(user_id: str, friend_id: str) -> bool:
+    """Ends a friendship on both sides
+
+    Returns:
+        bool: False if they were not friends
+    """
+    pipe = r.pipeline(transaction=True)
+    pipe.srem(friends_key(user_id), friend_id)
+    pipe.srem(friends_key(friend_id), user_id)
+    removed, _ = pipe.execute()
+    return bool(removed)
+
+
+def are_friends(user_id: str, other_id: str) -> bool:
+    """Checks if two users are friends, in O(1)"""
+    return bool(r.sismember(friends_key(user_id), other_id))
+
+
+def friends(user_id: str) -> set[str]:
+    """Gets the ids of a user's friends"""
+    return r.smembers(friends_key(user_id))
+
+
+def pending(user_id: str) -> set[str]:
+    """Gets the ids of users waiting for the user to accept their request"""
+    return r.smembers(pending_key(user_id))
+
+
+def sent(user_id: str) -> set[str]:
+    """Gets the ids of users the user sent a request to"""
+    return r.smembers(sent_key(user_id))
+
+
+def friends_many(user_ids: list[str]) -> dict:
+    """Gets the friends of several users in one round trip
+
+    Args:
+        user_ids (list[str]): The ids of the users
+
+    Returns:
+        dict: user id -> set of friend ids
+    """
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.smembers(friends_key(user_id))
+    return dict(zip(user_ids, pipe.execute()))
+
+
+def mutual(user_id: str, other_id: str) -> set[str]:
+    """Gets the friends two users have in common"""
+    return r.sinter(friends_key(user_id), friends_key(other_id))
+
+
+def suggestions(user_id: str, limit: int = 10) -> list[str]:
+    """Suggests friends of friends, ranked by friends in common
+
+    Samples a bounded number of friends and of their friends, so the
+    cost does not grow with the size of the graph
+
+    Args:
+        user_id (str): The id of the user
+        limit (int, optional): Max suggestions. Defaults to 10.
+
+    Returns:
+        list[str]: The ids of the suggested users
+    """
+    sample = r.srandmember(friends_key(user_id), SUGGESTION_SAMPLE)
+    if not sample:
+        return []
+    pipe = r.pipeline(transaction=False)
+    for friend_id in sample:
+        pipe.srandmember(friends_key(friend_id), SUGGESTION_FANOUT)
+    counts = Counter(
+        candidate
+        for friends_of_friend in pipe.execute()
+        for candidate in friends_of_friend
+        if candidate != user_id
+    )
+    if not counts:
+        return []
+    candidates = list(counts)
+    pipe = r.pipeline(transaction=False)
+    for key in (friends_key(user_id), pending_key(user_id), sent_key(user_id)):
+        pipe.smismember(key, candidates)
+    known = [any(flags) for flags in zip(*pipe.execute())]
+    ranked = sorted(
+        (candidate for candidate, skip in zip(candidates, known) if not skip),
+        key=lambda candidate: counts[candidate],
+        reverse=True,
+    )
+    return ranked[:limit]
+
+
+def migrate_user_lists() -> int:
+    """Copies the friend lists of old user records into the sets
+
+    Returns:
+        int: The number of users migrated
+    """
+    migrated = 0
+    for key in r.scan_iter(match="users:*", _type="string"):
+        raw = rb.get(key)
+        if not raw:
+            continue
+        data = codec.decode_record(LEGACY_FIELDS, raw)
+        user_id = key.split(":", 1)[1]
+        pipe = r.pipeline(transaction=True)
+        for field, key_of in (
+            ("friends", friends_key),
+            ("pending_friends", pending_key),
+            ("sent_friends", sent_key),
+        ):
+            ids = [value for value in data.get(field) or [] if isinstance(value, str)]
+            if ids:
+                pipe.sadd(key_of(user_id), *ids)
+        pipe.execute()
+        migrated += 1
+    return migrated
+
+
+if __name__ == "__main__":
+    print(f"Migrated {migrate_user_lists()} users")
@@ -0,0 +1,146 @@
+"""
+Hashing
+
+Password hashing off the request thread. Hashes run on a bounded pool
+of threads (hashlib releases the GIL while hashing) or processes, with
+a configurable werkzeug method such as ``scrypt:32768:8:1`` or
+``pbkdf2:sha256:600000``.
+"""
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusyError(Exception):
+    """Used when the hashing pool has too many pending hashes"""
+
+
+class PasswordHasher:
+    """Runs password hashes on a bounded pool"""
+
+    def __init__(
+        self,
+        method: str = "scrypt",
+        workers: int | None = None,
+        kind: str = "thread",
+        max_pending: int = 256,
+        timeout: float | None = None,
+    ):
+        """The constructor
+
+        Args:
+            method (str, optional): The werkzeug hash method. Defaults to "scrypt".
+            workers (int, optional): Pool size. Defaults to the number of cores.
+            kind (str, optional): "thread" or "process". Defaults to "thread".
+            max_pending (int, optional): Max queued or running hashes. Defaults to 256.
+            timeout (float, optional): Seconds to wait for a free slot. Defaults to forever.
+        """
+        self._pool: Executor | None = None
+        self._lock = threading.Lock()
+        self.configure(method, workers, kind, max_pending, timeout)
+
+    def configure(self, method: str, workers: int | None = None, kind: str = "thread",
+                  max_pending: int = 256, timeout: float | None = None) -> None:
+        """Changes the parameters, see the constructor
+
+        Stops the current pool, a new one starts on the next hash
+        """
+        self.shutdown()
+        self.method = method
+        self.workers = workers or os.cpu_count() or 1
+        self.kind = kind
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._prefix: str | None = None
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    if self.kind == "process":
+                        self._pool = ProcessPoolExecutor(self.workers)
+                    else:
+                        self._pool = ThreadPoolExecutor(
+                            self.workers, thread_name_prefix="password-hash"
+                        )
+        return self._pool
+
+    def _run(self, function, *args):
+        """Runs function on the pool and waits for its result"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HashingBusyError("Too many passwords waiting to be hashed")
+        try:
+            return self._get_pool().submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        """Hashes a password with the configured method
+
+        Args:
+            password (str): The un-hashed password
+
+        Returns:
+            str: The password hash
+        """
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash: str, password: str) -> bool:
+        """Checks a password against a hash
+
+        Args:
+            pwhash (str): The stored hash
+            password (str): The un-hashed password
+
+        Returns:
+            bool: If the password is correct
+        """
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        """Checks if a hash was made with other parameters than configured
+
+        Args:
+            pwhash (str): The stored hash
+
+        Returns:
+            bool: If the hash should be replaced
+        """
+        if self._prefix is None:
+            # Resolves defaults, e.g. "scrypt" -> "scrypt:32768:8:1"
+            self._prefix = self.hash("").split("$", 1)[0]
+        return pwhash.split("$", 1)[0] != self._prefix
+
+    def shutdown(self) -> None:
+        """Stops the pool"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+# Hasher shared by the worker
+hasher = PasswordHasher()
+
+
+def configure(method: str, workers: int | None = None, kind: str = "thread",
+              max_pending: int = 256, timeout: float | None = None) -> None:
+    """Reconfigures the shared hasher, see PasswordHasher"""
+    hasher.configure(method, workers, kind, max_pending, timeout)
+
+
+def hash_password(password: str) -> str:
+    """Hashes a password on the shared pool"""
+    return hasher.hash(password)
+
+
+def verify_password(pwhash: str, password: str) -> bool:
+    """Checks a password on the shared pool"""
+    return hasher.verify(pwhash, password)
+
+
+def needs_rehash(pwhash: str) -> bool:
+    """Checks a hash against the shared hasher's parameters"""
+    return hasher.needs_rehash(pwhash)
@@ -0,0 +1,163 @@
+"""
+IDs
+
+Time-sortable ids unique across workers, in the Snowflake layout:
+
+    41 bits milliseconds since EPOCH_MS | 10 bits worker id | 12 bits sequence
+
+Worker ids are leased from redis so no two live processes share one.
+A process stops minting ids as soon as its lease may have expired and
+claims a new worker id, so a lease lost to a long pause is never reused.
+Ids are handed out as decimal strings and sort by creation time when
+compared as integers.
+"""
+import os
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from service.common.redis_data import r
+
+# 2024-01-01T00:00:00Z
+EPOCH_MS = 1704067200000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKERS = 1 << WORKER_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Seconds a worker id lease lasts, renewed at a third of that
+LEASE_SECONDS = 60
+
+WORKER_COUNTER = "ids:workers:next"
+
+# Extends a lease only if it is still ours, returns 0 if it is not
+_RENEW = r.register_script(
+    """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+)
+
+
+def _lease_key(worker_id: int) -> str:
+    return f"ids:workers:{worker_id}"
+
+
+class IdGenerator:
+    """Hands out Snowflake ids for one process"""
+
+    def __init__(self):
+        self.worker_id = None
+        self._token = None
+        # Monotonic time by which the lease may have expired
+        self._lease_deadline = 0.0
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _claim_worker_id(self) -> int:
+        """Leases a free worker id from redis"""
+        # A token per lease, so a renewer of an earlier lease can tell it is stale
+        token = f"{os.getpid()}:{id(self)}:{time.monotonic_ns()}"
+        for _ in range(MAX_WORKERS):
+            candidate = r.incr(WORKER_COUNTER) % MAX_WORKERS
+            start = time.monotonic()
+            if r.set(_lease_key(candidate), token, nx=True, ex=LEASE_SECONDS):
+                self._token = token
+                self._lease_deadline = start + LEASE_SECONDS
+                return candidate
+        raise RuntimeError("No free worker id, all leases are taken")
+
+    def _renew(self, worker_id: int, token: str) -> None:
+        """Keeps a worker id lease alive until it is lost or replaced"""
+        while True:
+            time.sleep(LEASE_SECONDS / 3)
+            if self._token != token:
+                return
+            start = time.monotonic()
+            try:
+                renewed = _RENEW(keys=[_lease_key(worker_id)], args=[token, LEASE_SECONDS])
+            except RedisError:
+                # Retried on the next tick, the lease outlives one failure
+                continue
+            with self._lock:
+                if self._token != token:
+                    return
+                if not renewed:
+                    # Expired and maybe claimed by another process, stop minting
+                    self._release()
+                    return
+                self._lease_deadline = start + LEASE_SECONDS
+
+    def _release(self) -> None:
+        """Forgets the lease, the next id claims a new worker id"""
+        self.worker_id = None
+        self._token = None
+        self._lease_deadline = 0.0
+
+    def _ensure_worker_id(self) -> int:
+        if self.worker_id is not None and time.monotonic() >= self._lease_deadline:
+            # Not renewed in time, e.g. after a long pause
+            self._release()
+        if self.worker_id is None:
+            self.worker_id = self._claim_worker_id()
+            threading.Thread(
+                target=self._renew,
+                args=(self.worker_id, self._token),
+                name="id-worker-lease",
+                daemon=True,
+            ).start()
+        return self.worker_id
+
+    def next_id(self) -> int:
+        """Generates the next id
+
+        Returns:
+            int: The id
+        """
+        with self._lock:
+            worker_id = self._ensure_worker_id()
+            now = int(time.time() * 1000)
+            # The clock went backwards, wait for it to catch up
+            while now < self._last_ms:
+                time.sleep((self._last_ms - now) / 1000)
+                now = int(time.time() * 1000)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond
+                    while now <= self._last_ms:
+                        now = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (
+                ((now - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS))
+                | (worker_id << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+    def reset(self) -> None:
+        """Forgets the worker id, used in forked children"""
+        self._release()
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+
+# Generator shared by the process
+generator = IdGenerator()
+os.register_at_fork(after_in_child=generator.reset)
+
+
+def new_id() -> str:
+    """Generates a new id
+
+    Returns:
+        str: The id as a decimal string
+    """
+    return str(generator.next_id())
@@ -0,0 +1,111 @@
+"""
+Inbox
+
+Per-user list of chats ordered by last activity, with unread counts.
+
+    inbox:{user_id}   sorted set, chat id -> time of the last message
+    unread:{user_id}  hash, chat id -> messages not yet read
+    chats:{chat_id}:members  set of member ids
+
+A sent message updates every member's inbox and the chat's preview in
+the same script that appends it, see persistence.append_message; the top
+of an inbox with previews and unread counts is read back in two round
+trips.
+"""
+from service.common.redis_data import r
+
+# Characters of the last message kept as the chat preview
+PREVIEW_LENGTH = 100
+
+
+def members_key(chat_id: str) -> str:
+    """Gets the key of a chat's member set"""
+    return f"chats:{chat_id}:members"
+
+
+def inbox_key(user_id: str) -> str:
+    """Gets the key of a user's inbox"""
+    return f"inbox:{user_id}"
+
+
+def unread_key(user_id: str) -> str:
+    """Gets the key of a user's unread counts"""
+    return f"unread:{user_id}"
+
+
+def add_chat(chat_id: str, member_ids: list[str], created: float, client=None) -> None:
+    """Puts a chat in its members' inboxes, keeps existing entries
+
+    Args:
+        chat_id (str): The id of the chat
+        member_ids (list[str]): The ids of the members
+        created (float): When the chat was created
+        client (Redis, optional): Client or pipeline to queue the writes on
+    """
+    client = r if client is None else client
+    if not member_ids:
+        return
+    client.sadd(members_key(chat_id), *member_ids)
+    for member_id in member_ids:
+        client.zadd(inbox_key(member_id), {chat_id: created}, nx=True)
+
+
+def mark_read(user_id: str, chat_id: str) -> None:
+    """Clears the unread count of a chat for a user"""
+    r.hdel(unread_key(user_id), chat_id)
+
+
+def top(user_id: str, limit: int = 50) -> list[dict]:
+    """Gets the most recently active chats of a user, in two round trips
+
+    Args:
+        user_id (str): The id of the user
+        limit (int, optional): Max number of chats. Defaults to 50.
+
+    Returns:
+        list[dict]: The chats with their preview and unread count, newest first
+    """
+    entries = r.zrevrange(inbox_key(user_id), 0, limit - 1, withscores=True)
+    if not entries:
+        return []
+    chat_ids = [chat_id for chat_id, _ in entries]
+    pipe = r.pipeline(transaction=False)
+    for chat_id in chat_ids:
+        pipe.hmget(f"chats:{chat_id}", "chat_name", "last_content", "last_user")
+    pipe.hmget(unread_key(user_id), chat_ids)
+    *previews, unread = pipe.execute()
+    return [
+        {
+            "chat_id": chat_id,
+            "last_time": float(last_time),
+            "chat_name": chat_name or "",
+            "last_content": last_content or "",
+            "last_user": last_user or "",
+            "unread": int(count or 0),
+        }
+        for (chat_id, last_time), (chat_name, last_content, last_user), count
+        in zip(entries, previews, unread)
+    ]
+
+
+def backfill() -> int:
+    """Builds member sets and inboxes for chats created before the inbox
+
+    Returns:
+        int: The number of chats indexed
+    """
+    # Imported here, the models import this module
+    from service.classes import Chat  # pylint: disable=import-outside-toplevel
+
+    indexed = 0
+    for key in r.scan_iter(match="chats:*", _type="hash"):
+        chat = Chat.load(key.split(":", 1)[1])
+        if chat is None:
+            continue
+        add_chat(chat.id, chat.members, float(chat.start_date))
+        indexed += 1
+    return indexed
+
+
+if __name__ == "__main__":
+    print(f"Indexed {backfill()} chats")
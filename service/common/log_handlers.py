@@ -3,19 +3,204 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+Records are put on a bounded queue by the request thread and formatted
+and written by a QueueListener thread, so slow log I/O never blocks a
+request. Access logs go through a per-endpoint sampler and rate cap
+before they are queued.
 """
+import atexit
+import json
 import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import request
+
+from service.common import metrics
+
+# Logger of one line per request, see init_access_log
+access_logger = logging.getLogger("service.access")
+
+# Records waiting for the listener before new ones are dropped
+QUEUE_SIZE = 10000
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line
+
+    Fields passed as ``extra={"fields": {...}}`` are merged in
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queues records without formatting them, drops them when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AccessSampler(logging.Filter):
+    """Samples access logs and caps them per endpoint and second
+
+    Runs on the request thread without a lock; concurrent requests may
+    let a few records past the cap, which is fine for logs. Warnings,
+    e.g. server errors, always pass
+    """
+
+    def __init__(self, rates: dict | None = None, default_rate: float = 1.0,
+                 cap_per_second: int = 0):
+        """The constructor
+
+        Args:
+            rates (dict, optional): endpoint -> fraction of requests logged
+            default_rate (float, optional): Fraction for other endpoints. Defaults to 1.0.
+            cap_per_second (int, optional): Max records per endpoint and second, 0 for none
+        """
+        super().__init__()
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.cap_per_second = cap_per_second
+        self.suppressed = 0
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        fields = getattr(record, "fields", None) or {}
+        endpoint = fields.get("endpoint")
+        rate = self.rates.get(endpoint, self.default_rate)
+        if rate < 1 and random.random() >= rate:
+            return False
+        if self.cap_per_second:
+            second = int(time.monotonic())
+            window = self._windows.get(endpoint)
+            if window is None or window[0] != second:
+                window = self._windows[endpoint] = [second, 0]
+            window[1] += 1
+            if window[1] > self.cap_per_second:
+                self.suppressed += 1
+                return False
+        if rate < 1:
+            fields["sample_rate"] = rate
+        return True
+
+
+def _start_listener(handlers: list, queue_size: int) -> DroppingQueueHandler:
+    """Moves handlers behind a queue drained by a listener thread"""
+    global _listener  # pylint: disable=global-statement
+    _stop_listener()
+    log_queue = queue.Queue(queue_size)
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return DroppingQueueHandler(log_queue)
+
+
+def _stop_listener() -> None:
+    """Writes out queued records, at exit or before a new listener starts"""
+    global _listener  # pylint: disable=global-statement
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def init_access_log(app, sampler: AccessSampler) -> None:
+    """Logs one structured line per request of app
+
+    Args:
+        app (Flask): The app
+        sampler (AccessSampler): Drops records before they are queued
+    """
+    access_logger.filters = [sampler]
+    metrics.time_requests(app)
+
+    @app.after_request
+    def _log_request(response):
+        if not access_logger.isEnabledFor(logging.INFO):
+            return response
+        elapsed = metrics.request_seconds()
+        access_logger.log(
+            logging.WARNING if response.status_code >= 500 else logging.INFO,
+            "%s %s %s",
+            request.method,
+            request.path,
+            response.status_code,
+            extra={
+                "fields": {
+                    "endpoint": request.endpoint or "unmatched",
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "remote_addr": request.remote_addr,
+                    "duration_ms": None if elapsed is None else round(elapsed * 1000, 3),
+                }
+            },
+        )
+        return response
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s\
-                                   %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOGGING_FORMAT", "json") == "json":
+        formatter = JsonFormatter(datefmt="%Y-%m-%dT%H:%M:%S%z")
+    else:
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+        )
+    # Without gunicorn, e.g. under wsgi.py, write to stderr like logging.lastResort
+    handlers = list(gunicorn_logger.handlers) or [logging.StreamHandler(sys.stderr)]
+    for handler in handlers:
         handler.setFormatter(formatter)
+    queue_handler = _start_listener(handlers, int(app.config.get("LOGGING_QUEUE_SIZE", QUEUE_SIZE)))
+    app.logger.handlers = [queue_handler]
+
+    access_logger.propagate = False
+    access_logger.setLevel(gunicorn_logger.level)
+    access_logger.handlers = [queue_handler]
+    sampler = AccessSampler(
+        app.config.get("ACCESS_LOG_SAMPLE_RATES"),
+        float(app.config.get("ACCESS_LOG_SAMPLE_RATE", 1.0)),
+        int(app.config.get("ACCESS_LOG_RATE_CAP", 0)),
+    )
+    init_access_log(app, sampler)
+    metrics.add_collector(
+        "logging",
+        lambda: {"dropped": queue_handler.dropped, "suppressed": sampler.suppressed},
+    )
     app.logger.info("Logging handler established")
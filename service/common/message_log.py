@@ -0,0 +1,183 @@
+"""
+Message Log
+
+Append-only message history for chats, stored as one Redis Stream
+per chat under ``chats:{chat_id}:messages``. Appends are O(1) and
+readers fetch a window of history with XRANGE/XREVRANGE instead of
+decoding the whole chat.
+
+Every entry also carries ``seq``, a per-chat sequence number without
+gaps, so clients can tell when they missed a message.
+"""
+import json
+
+from service.common.redis_data import r
+
+MESSAGE_FIELDS = ("id", "user", "content", "sent_time", "edited_time")
+# Stored as strings, read back as floats like live messages carry them
+TIME_FIELDS = ("sent_time", "edited_time")
+
+# KEYS: sequence counter, stream
+# ARGV: field, value, field, value, ...
+# Returns: {entry id, seq}
+_APPEND = r.register_script(
+    """
+    local seq = redis.call('INCR', KEYS[1])
+    local entry_id = redis.call('XADD', KEYS[2], '*', 'seq', seq, unpack(ARGV))
+    return {entry_id, seq}
+    """
+)
+
+
+def stream_key(chat_id: str) -> str:
+    """Returns the stream key holding a chat's messages
+
+    Args:
+        chat_id (str): The id of the chat
+
+    Returns:
+        str: The redis key
+    """
+    return f"chats:{chat_id}:messages"
+
+
+def seq_key(chat_id: str) -> str:
+    """Returns the key of a chat's sequence counter"""
+    return f"chats:{chat_id}:seq"
+
+
+def is_cursor(value) -> bool:
+    """Checks a client supplied cursor looks like a stream entry id"""
+    if not isinstance(value, str):
+        return False
+    millis, _, sequence = value.partition("-")
+    return millis.isdigit() and (sequence == "" or sequence.isdigit())
+
+
+def to_fields(message: dict) -> dict:
+    """Flattens a serialized message into stream fields"""
+    return {
+        field: "" if message.get(field) is None else str(message[field])
+        for field in MESSAGE_FIELDS
+    }
+
+
+def _from_entry(entry) -> dict:
+    """Turns a stream entry into a serialized message"""
+    entry_id, fields = entry
+    result = dict(fields)
+    result["cursor"] = entry_id
+    if "seq" in result:
+        result["seq"] = int(result["seq"])
+    for field in TIME_FIELDS:
+        if field in result:
+            result[field] = float(result[field]) if result[field] else None
+    return result
+
+
+def append(chat_id: str, message: dict, client=None):
+    """Appends a message to the end of a chat's log
+
+    Args:
+        chat_id (str): The id of the chat
+        message (dict): The serialized message
+        client (Redis, optional): Client or pipeline to queue the command on
+
+    Returns:
+        list: The stream entry id, usable as a cursor, and the message's seq
+    """
+    args = []
+    for field, value in to_fields(message).items():
+        args.extend((field, value))
+    return _APPEND(
+        keys=[seq_key(chat_id), stream_key(chat_id)],
+        args=args,
+        client=r if client is None else client,
+    )
+
+
+def latest(chat_id: str, limit: int = 50) -> list[dict]:
+    """Gets the newest messages of a chat, oldest first
+
+    Args:
+        chat_id (str): The id of the chat
+        limit (int, optional): Max number of messages. Defaults to 50.
+
+    Returns:
+        list[dict]: The messages
+    """
+    entries = r.xrevrange(stream_key(chat_id), count=limit)
+    return [_from_entry(entry) for entry in reversed(entries)]
+
+
+def before(chat_id: str, cursor: str, limit: int = 50) -> list[dict]:
+    """Gets the messages strictly older than a cursor, oldest first
+
+    Args:
+        chat_id (str): The id of the chat
+        cursor (str): The stream entry id to page back from
+        limit (int, optional): Max number of messages. Defaults to 50.
+
+    Returns:
+        list[dict]: The messages
+    """
+    entries = r.xrevrange(stream_key(chat_id), max=f"({cursor}", count=limit)
+    return [_from_entry(entry) for entry in reversed(entries)]
+
+
+def after_many(cursors: dict, limit: int = 50) -> dict:
+    """Gets the messages newer than a cursor for several chats in one round trip
+
+    Args:
+        cursors (dict): chat id -> cursor, "0" for the start of the chat
+        limit (int, optional): Max messages per chat. Defaults to 50.
+
+    Returns:
+        dict: chat id -> messages, oldest first
+    """
+    pipe = r.pipeline(transaction=False)
+    for chat_id, cursor in cursors.items():
+        pipe.xrange(stream_key(chat_id), min=f"({cursor}", count=limit)
+    return {
+        chat_id: [_from_entry(entry) for entry in entries]
+        for chat_id, entries in zip(cursors, pipe.execute())
+    }
+
+
+def _legacy_message(item) -> dict | None:
+    """Resolves an entry of the old JSON ``messages`` list"""
+    if isinstance(item, dict):
+        return item
+    if isinstance(item, str):
+        stored = r.hgetall(f"messages:{item}")
+        return stored or None
+    return None
+
+
+def migrate_chat_hashes() -> int:
+    """Moves the JSON ``messages`` field of every chat hash into its stream
+
+    Safe to re-run: chats without a ``messages`` field are skipped.
+
+    Returns:
+        int: The number of chats migrated
+    """
+    migrated = 0
+    for key in r.scan_iter(match="chats:*", _type="hash"):
+        raw = r.hget(key, "messages")
+        if raw is None:
+            continue
+        chat_id = key.split(":", 1)[1]
+        pipe = r.pipeline(transaction=True)
+        for item in json.loads(raw) or []:
+            message = _legacy_message(item)
+            if message is not None:
+                append(chat_id, message, client=pipe)
+        pipe.hdel(key, "messages")
+        pipe.execute()
+        migrated += 1
+    return migrated
+
+
+if __name__ == "__main__":
+    print(f"Migrated {migrate_chat_hashes()} chats")
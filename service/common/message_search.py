@@ -0,0 +1,222 @@
+"""
+Message Search
+
+Full-text search over message content, limited to the chats a user is
+in. Sent messages are queued and indexed by a background thread, so the
+send path only pays for a queue put. The index is RediSearch when the
+server has it (redis-stack), otherwise an in-process inverted index
+that only sees this worker's messages, meant for tests and development.
+"""
+import logging
+import queue
+import re
+import threading
+from collections import defaultdict
+
+from redis.commands.search.field import NumericField, TagField, TextField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from redis.exceptions import RedisError, ResponseError
+
+from service.common.redis_data import r
+from service.common.user_search import has_search
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_PREFIX = "msgidx:"
+SEARCH_INDEX = "idx:messages"
+
+# Pending messages kept before new ones are dropped
+QUEUE_SIZE = 10000
+# Messages written per pipeline
+BATCH_SIZE = 200
+
+_TOKEN = re.compile(r"\w+")
+_SEARCH_SPECIAL = re.compile(r"([^\w\s])")
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits text into lowercase words"""
+    return _TOKEN.findall(text.lower())
+
+
+class RediSearchIndex:
+    """Messages stored as hashes indexed by RediSearch"""
+
+    def create(self) -> None:
+        """Creates the index if it does not exist"""
+        try:
+            r.ft(SEARCH_INDEX).create_index(
+                [
+                    TextField("content"),
+                    TagField("chat_id"),
+                    NumericField("sent_time", sortable=True),
+                ],
+                definition=IndexDefinition(
+                    prefix=[MESSAGE_PREFIX], index_type=IndexType.HASH
+                ),
+            )
+        except ResponseError as error:
+            if "already exists" not in str(error):
+                raise
+
+    def add(self, batch: list[dict]) -> None:
+        """Indexes a batch of messages"""
+        pipe = r.pipeline(transaction=False)
+        for message in batch:
+            pipe.hset(f"{MESSAGE_PREFIX}{message['id']}", mapping=message)
+        pipe.execute()
+
+    def search(self, chat_ids: list[str], query: str, offset: int, limit: int):
+        """Finds messages in chat_ids matching query
+
+        Returns:
+            tuple[int, list[dict]]: The total hits and the requested page
+        """
+        words = _SEARCH_SPECIAL.sub(r"\\\1", query)
+        chats = "|".join(chat_ids)
+        result = r.ft(SEARCH_INDEX).search(
+            Query(f"@content:({words}) @chat_id:{{{chats}}}").paging(offset, limit)
+        )
+        hits = []
+        for document in result.docs:
+            hit = {
+                key: getattr(document, key, "")
+                for key in ("id", "chat_id", "cursor", "user", "content", "sent_time")
+            }
+            hits.append(hit)
+        return result.total, hits
+
+
+class InvertedIndex:
+    """In-process inverted index, ranked by matching words then recency"""
+
+    def __init__(self):
+        self._postings = defaultdict(set)
+        self._messages = {}
+        self._lock = threading.Lock()
+
+    def create(self) -> None:
+        """Nothing to create"""
+
+    def add(self, batch: list[dict]) -> None:
+        """Indexes a batch of messages"""
+        with self._lock:
+            for message in batch:
+                self._messages[message["id"]] = message
+                for word in set(tokenize(message["content"])):
+                    self._postings[word].add(message["id"])
+
+    def search(self, chat_ids: list[str], query: str, offset: int, limit: int):
+        """Finds messages in chat_ids matching query
+
+        Returns:
+            tuple[int, list[dict]]: The total hits and the requested page
+        """
+        chats = set(chat_ids)
+        scores = defaultdict(int)
+        with self._lock:
+            for word in set(tokenize(query)):
+                for message_id in self._postings.get(word, ()):
+                    if self._messages[message_id]["chat_id"] in chats:
+                        scores[message_id] += 1
+            ranked = sorted(
+                scores,
+                key=lambda message_id: (
+                    scores[message_id],
+                    float(self._messages[message_id]["sent_time"] or 0),
+                ),
+                reverse=True,
+            )
+            hits = [dict(self._messages[message_id]) for message_id in ranked]
+        return len(hits), hits[offset:offset + limit]
+
+
+class MessageIndexer:
+    """Queues sent messages and indexes them on a background thread"""
+
+    def __init__(self):
+        self.backend = None
+        self.dropped = 0
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _get_backend(self):
+        if self.backend is None:
+            self.backend = RediSearchIndex() if has_search() else InvertedIndex()
+            self.backend.create()
+        return self.backend
+
+    def start(self) -> None:
+        """Starts the indexing thread, once"""
+        with self._lock:
+            if self._thread is None:
+                self._get_backend()
+                self._thread = threading.Thread(
+                    target=self._run, name="message-indexer", daemon=True
+                )
+                self._thread.start()
+
+    def enqueue(self, chat_id: str, message: dict, cursor: str) -> None:
+        """Queues a sent message for indexing, never blocks
+
+        Args:
+            chat_id (str): The id of the chat
+            message (dict): The serialized message
+            cursor (str): The stream entry id of the message
+        """
+        if self._thread is None:
+            self.start()
+        document = {
+            "id": str(message["id"]),
+            "chat_id": chat_id,
+            "cursor": cursor,
+            "user": str(message["user"]),
+            "content": str(message["content"]),
+            "sent_time": message["sent_time"],
+        }
+        try:
+            self._queue.put_nowait(document)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.backend.add(batch)
+            except RedisError as error:
+                logger.warning("Failed to index %s messages: %s", len(batch), error)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def join(self) -> None:
+        """Waits for every queued message to be indexed"""
+        self._queue.join()
+
+    def search(self, chat_ids: list[str], query: str, offset: int = 0, limit: int = 20):
+        """Finds messages in chat_ids matching query
+
+        Args:
+            chat_ids (list[str]): The chats the caller is in
+            query (str): The words to look for
+            offset (int, optional): Hits to skip. Defaults to 0.
+            limit (int, optional): Hits to return. Defaults to 20.
+
+        Returns:
+            tuple[int, list[dict]]: The total hits and the requested page
+        """
+        if not chat_ids or not tokenize(query):
+            return 0, []
+        return self._get_backend().search(chat_ids, query, offset, limit)
+
+
+# Indexer shared by the worker
+indexer = MessageIndexer()
@@ -0,0 +1,432 @@
+"""
+Metrics
+
+Counters, gauges and histograms exposed in the Prometheus text format
+on ``/metrics``.
+
+Recording takes no lock: each thread writes to its own shard of every
+metric and a scrape sums the shards. The shard of a finished thread is
+folded into the metric's base shard, so short-lived handler threads do
+not pile up. Each worker publishes a snapshot to redis every publish
+interval, and a scrape of any worker reports the snapshots of every
+live worker under a ``worker`` label, so one scrape target covers the
+whole deployment.
+"""
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from flask import g, request
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Hash of worker name -> last published snapshot
+WORKERS_KEY = "metrics:workers"
+
+# Seconds between snapshots published by each worker
+PUBLISH_INTERVAL = 10
+# Published intervals missed before a worker is dropped from scrapes
+STALE_INTERVALS = 3
+
+# Seconds, from a redis round trip to a slow password hash
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+# Every metric of the worker, in registration order
+REGISTRY = []
+# Prefix -> callable returning {name: value} of gauges read at scrape time
+_COLLECTORS = {}
+
+
+class _ShardHolder:
+    """Holds a thread's shard, dropped with the thread's locals when it ends"""
+
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self, shard: dict):
+        self.shard = shard
+
+
+class _Metric:
+    """A metric whose samples are kept in one shard per live thread"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        """The constructor
+
+        Args:
+            name (str): The metric name
+            help_text (str): The HELP line
+            labels (tuple, optional): The label names
+        """
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._local = threading.local()
+        # Samples of finished threads
+        self._base = {}
+        # id -> shard of every live thread
+        self._shards = {}
+        # Taken when a thread starts or ends and on scrapes, never to record.
+        # Reentrant, a finalizer may run while a scrape holds it
+        self._lock = threading.RLock()
+        REGISTRY.append(self)
+
+    def _shard(self) -> dict:
+        """Gets the calling thread's shard, label values -> sample"""
+        try:
+            return self._local.holder.shard
+        except AttributeError:
+            shard = {}
+            holder = self._local.holder = _ShardHolder(shard)
+            weakref.finalize(holder, self._retire, shard)
+            with self._lock:
+                self._shards[id(shard)] = shard
+            return shard
+
+    def _retire(self, shard: dict) -> None:
+        """Folds the shard of a finished thread into the base shard"""
+        with self._lock:
+            self._shards.pop(id(shard), None)
+            for labels, sample in shard.items():
+                self._base[labels] = _add(self._base.get(labels), sample)
+
+    def samples(self) -> dict:
+        """Sums the shards of every thread
+
+        Returns:
+            dict: label values -> sample
+        """
+        with self._lock:
+            merged = {labels: _add(None, sample) for labels, sample in self._base.items()}
+            for shard in list(self._shards.values()):
+                for labels, sample in list(shard.items()):
+                    merged[labels] = _add(merged.get(labels), sample)
+        return merged
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        """Adds amount to the sample of labels"""
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """A value that goes up and down"""
+
+    kind = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1) -> None:
+        """Subtracts amount from the sample of labels"""
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    """Observations counted in buckets, with their sum"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        """The constructor
+
+        Args:
+            name (str): The metric name
+            help_text (str): The HELP line
+            labels (tuple, optional): The label names
+            buckets (tuple, optional): Upper bounds of the buckets, ascending
+        """
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, labels: tuple, value: float) -> None:
+        """Records an observation
+
+        Args:
+            labels (tuple): The label values
+            value (float): The observed value, e.g. seconds
+        """
+        shard = self._shard()
+        sample = shard.get(labels)
+        if sample is None:
+            # A count per bucket, one for +Inf, then the sum
+            sample = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        sample[bisect_left(self.buckets, value)] += 1
+        sample[-1] += value
+
+    def time(self, labels: tuple):
+        """Decorates a function to observe how long each call takes"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(labels, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+
+def _add(first, second):
+    """Adds two samples, numbers or histogram lists"""
+    if first is None:
+        return list(second) if isinstance(second, list) else second
+    if isinstance(first, list):
+        return [a + b for a, b in zip(first, second)]
+    return first + second
+
+
+HTTP_REQUESTS = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ("endpoint", "method", "status"),
+)
+REDIS_COMMANDS = Histogram(
+    "redis_command_duration_seconds",
+    "Redis round trip time, pipelines count as one command",
+    ("command",),
+)
+REDIS_ERRORS = Counter("redis_command_errors_total", "Redis commands that raised", ("command",))
+SOCKET_CONNECTIONS = Gauge("socketio_connections", "Open Socket.IO connections")
+SOCKET_EVENTS = Histogram(
+    "socketio_event_duration_seconds",
+    "Time spent handling received Socket.IO events",
+    ("event",),
+)
+
+
+def add_collector(prefix: str, collect) -> None:
+    """Reports a stats dict as gauges at every snapshot
+
+    Args:
+        prefix (str): Prepended to each key of the dict
+        collect (Callable): Returns {name: number}
+    """
+    _COLLECTORS[prefix] = collect
+
+
+def worker_name() -> str:
+    """Names this worker process, after any fork"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def snapshot() -> dict:
+    """Gets every sample of this worker
+
+    Returns:
+        dict: name -> {"kind", "help", "labels", "buckets", "samples"}
+    """
+    metrics = {}
+    for metric in REGISTRY:
+        metrics[metric.name] = {
+            "kind": metric.kind,
+            "help": metric.help,
+            "labels": list(metric.labels),
+            "buckets": list(getattr(metric, "buckets", ())),
+            "samples": [[list(labels), sample] for labels, sample in metric.samples().items()],
+        }
+    for prefix, collect in list(_COLLECTORS.items()):
+        for key, value in collect().items():
+            metrics[f"{prefix}_{key}"] = {
+                "kind": "gauge",
+                "help": f"{prefix} {key}".replace("_", " "),
+                "labels": [],
+                "buckets": [],
+                "samples": [[[], value]],
+            }
+    return metrics
+
+
+def merge(snapshots: dict) -> dict:
+    """Combines the snapshots of several workers
+
+    Samples are labeled with their worker rather than summed, so gauges
+    such as queue depths stay meaningful and the counters of a worker
+    that goes away disappear instead of falling
+
+    Args:
+        snapshots (dict): worker name -> snapshot
+
+    Returns:
+        dict: name -> metric, with samples keyed by label values
+    """
+    merged = {}
+    for worker, metrics in snapshots.items():
+        for name, metric in metrics.items():
+            target = merged.setdefault(
+                name, {**metric, "labels": ["worker", *metric["labels"]], "samples": {}}
+            )
+            for labels, sample in metric["samples"]:
+                target["samples"][(worker, *labels)] = sample
+    return merged
+
+
+def publish() -> None:
+    """Stores this worker's snapshot for the other workers' scrapes"""
+    # Imported here, the redis client is instrumented with this module
+    from service.common.redis_data import r  # pylint: disable=import-outside-toplevel
+
+    r.hset(WORKERS_KEY, worker_name(), json.dumps({"time": time.time(), "metrics": snapshot()}))
+
+
+def collect_all(interval: float = PUBLISH_INTERVAL) -> dict:
+    """Merges this worker's samples with the live workers' published ones
+
+    Snapshots older than STALE_INTERVALS intervals are deleted
+
+    Returns:
+        dict: The merged metrics, see merge
+    """
+    # Imported here, the redis client is instrumented with this module
+    from service.common.redis_data import r  # pylint: disable=import-outside-toplevel
+
+    own = worker_name()
+    snapshots = {own: snapshot()}
+    cutoff = time.time() - interval * STALE_INTERVALS
+    stale = []
+    try:
+        for name, raw in r.hgetall(WORKERS_KEY).items():
+            if name == own:
+                continue
+            published = json.loads(raw)
+            if published["time"] < cutoff:
+                stale.append(name)
+            else:
+                snapshots[name] = published["metrics"]
+        if stale:
+            r.hdel(WORKERS_KEY, *stale)
+    except RedisError as error:
+        logger.warning("Reading other workers' metrics failed: %s", error)
+    return merge(snapshots)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(metrics: dict) -> str:
+    """Formats metrics in the Prometheus text format
+
+    Args:
+        metrics (dict): Merged metrics, see merge
+
+    Returns:
+        str: The exposition text
+    """
+    lines = []
+    for name, metric in metrics.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        names = metric["labels"]
+        for labels, sample in metric["samples"].items():
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{_labels(names, labels)} {sample}")
+                continue
+            cumulative = 0
+            bounds = [*metric["buckets"], "+Inf"]
+            for bound, count in zip(bounds, sample):
+                cumulative += count
+                label = _labels(names, labels, f'le="{bound}"')
+                lines.append(f"{name}_bucket{label} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, labels)} {sample[-1]}")
+            lines.append(f"{name}_count{_labels(names, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def timed_event(event: str):
+    """Decorates a Socket.IO handler to observe its latency
+
+    Args:
+        event (str): The event name used as the label
+    """
+    return SOCKET_EVENTS.time((event,))
+
+
+def time_requests(app) -> None:
+    """Records when each request of app starts, once per app
+
+    The metrics and the access log read the same start, see request_seconds
+    """
+    if app.extensions.get("request_timer"):
+        return
+    app.extensions["request_timer"] = True
+
+    @app.before_request
+    def _start_timer():
+        g.request_start = time.perf_counter()
+
+
+def request_seconds() -> float | None:
+    """Gets the seconds since the current request started, None if it wasn't timed"""
+    start = g.get("request_start")
+    return None if start is None else time.perf_counter() - start
+
+
+def instrument_app(app) -> None:
+    """Observes the latency of every request of app"""
+    time_requests(app)
+
+    @app.after_request
+    def _observe(response):
+        elapsed = request_seconds()
+        if elapsed is not None:
+            HTTP_REQUESTS.observe(
+                (request.endpoint or "unmatched", request.method, str(response.status_code)),
+                elapsed,
+            )
+        return response
+
+
+class MetricsPublisher:
+    """Publishes the worker's snapshot on an interval"""
+
+    def __init__(self):
+        self.interval = PUBLISH_INTERVAL
+        self._started = False
+        self._lock = threading.Lock()
+
+    def _run(self, socketio) -> None:
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                publish()
+            except RedisError as error:
+                logger.warning("Publishing metrics failed: %s", error)
+
+    def start(self, socketio) -> None:
+        """Starts the publish loop, once
+
+        Args:
+            socketio (SocketIO): Runs the background task
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._run, socketio)
+
+
+# Publisher shared by the worker
+publisher = MetricsPublisher()
@@ -0,0 +1,265 @@
+"""
+Outbound
+
+Per-socket batching and backpressure for Socket.IO emits. The client
+managers below hand each local delivery to a dispatcher instead of
+writing a frame straight away. Every window the dispatcher sends each
+socket one frame: the event itself, or a ``batch`` event holding
+``[event, data]`` pairs when several piled up.
+
+Each socket has a bounded queue. When a socket falls behind (its
+queue, or engine.io's own queue, fills up) droppable events such as
+presence and typing are dropped first; if that is not enough the
+socket is disconnected.
+"""
+import threading
+from collections import deque
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+# Events that may be dropped for slow sockets
+DROPPABLE_EVENTS = frozenset({"presence", "typing"})
+
+# Milliseconds events are held to be coalesced, 0 sends right away
+WINDOW_MS = 20
+# Events queued per socket before the slow consumer policy applies
+MAX_QUEUE = 256
+# Frames waiting in engine.io above which a socket counts as slow
+EIO_HIGH_WATER = 64
+
+
+class OutboundDispatcher:
+    """Coalesces events per socket and applies backpressure"""
+
+    def __init__(self):
+        self.window_ms = WINDOW_MS
+        self.max_queue = MAX_QUEUE
+        self.eio_high_water = EIO_HIGH_WATER
+        self.manager = None
+        self.dropped = 0
+        self.disconnected = 0
+        self.frames = 0
+        self.events = 0
+        self._queues = {}
+        self._slow = set()
+        self._lock = threading.Lock()
+        self._started = False
+
+    @property
+    def active(self) -> bool:
+        """If emits are being batched"""
+        return self._started and self.window_ms > 0
+
+    def _push(self, key, item) -> None:
+        """Queues an event for a socket, applying the slow consumer policy
+
+        Args:
+            key (tuple): The namespace, sid and engine.io sid of the socket
+            item (list): The event, its arguments and its encoding once known,
+                shared by every socket it was emitted to
+        """
+        pending = self._queues.setdefault(key, deque())
+        if len(pending) >= self.max_queue:
+            pending = self._drop_droppable(key, pending)
+        if len(pending) >= self.max_queue:
+            if item[0] in DROPPABLE_EVENTS:
+                self.dropped += 1
+                return
+            self._slow.add(key)
+        pending.append(item)
+
+    def _drop_droppable(self, key, pending: deque) -> deque:
+        """Removes the droppable events from a socket's queue"""
+        kept = deque(item for item in pending if item[0] not in DROPPABLE_EVENTS)
+        self.dropped += len(pending) - len(kept)
+        self._queues[key] = kept
+        return kept
+
+    def _hold(self, key, held: deque) -> None:
+        """Puts events back in front of the ones queued since they were taken"""
+        with self._lock:
+            pending = self._queues.setdefault(key, deque())
+            pending.extendleft(reversed(held))
+            if len(pending) > self.max_queue:
+                pending = self._drop_droppable(key, pending)
+            if len(pending) > self.max_queue:
+                self._slow.add(key)
+
+    def enqueue(self, event, data, namespace, room=None, skip_sid=None) -> None:
+        """Queues an event for every local socket in a room
+
+        Args:
+            event (str): The event name
+            data (list): The event arguments
+            namespace (str): The namespace
+            room (str, optional): The room, None for every socket
+            skip_sid (str | list, optional): Sockets to leave out
+        """
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        participants = list(self.manager.get_participants(namespace, room))
+        # One item for the whole room, so it is encoded at most once
+        item = [event, data, None]
+        with self._lock:
+            for sid, eio_sid in participants:
+                if sid not in skip_sid:
+                    self._push((namespace, sid, eio_sid), item)
+
+    def _encode(self, event, data, namespace) -> list:
+        """Encodes an event into the engine.io packets that carry it"""
+        pkt = self.manager.server.packet_class(
+            packet.EVENT, namespace=namespace, data=[event, *data]
+        )
+        encoded = pkt.encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        return [eio_packet.Packet(eio_packet.MESSAGE, part) for part in encoded]
+
+    def _eio_backlog(self, eio_sid) -> int:
+        """Gets how many frames engine.io still has to write to a socket"""
+        eio_socket = self.manager.server.eio.sockets.get(eio_sid)
+        queue = getattr(eio_socket, "queue", None)
+        return queue.qsize() if queue is not None else 0
+
+    def flush(self) -> None:
+        """Sends every socket its pending events as one frame
+
+        Sockets of a room that were sent the same events share one encoding
+        """
+        with self._lock:
+            queues, self._queues = self._queues, {}
+            slow, self._slow = self._slow, set()
+        batches = {}
+        for key, pending in queues.items():
+            namespace, sid, eio_sid = key
+            if key in slow:
+                self.disconnected += 1
+                self.manager.server.disconnect(sid, namespace=namespace)
+                continue
+            if not self.manager.is_connected(sid, namespace):
+                continue
+            if self._eio_backlog(eio_sid) > self.eio_high_water:
+                # Hold the events, they count against the socket's queue
+                self._hold(key, pending)
+                continue
+            if len(pending) == 1:
+                item = pending[0]
+                if item[2] is None:
+                    item[2] = self._encode(item[0], item[1], namespace)
+                encoded = item[2]
+            else:
+                # The items are shared and alive until the flush ends
+                batch_key = (namespace, *(id(item) for item in pending))
+                encoded = batches.get(batch_key)
+                if encoded is None:
+                    batch = [[event, *data] for event, data, _ in pending]
+                    encoded = batches[batch_key] = self._encode("batch", [batch], namespace)
+            for part in encoded:
+                self.manager.server._send_eio_packet(eio_sid, part)  # pylint: disable=protected-access
+            self.frames += 1
+            self.events += len(pending)
+
+    def stats(self) -> dict:
+        """Gets the queue depth and drop counters
+
+        Returns:
+            dict: The counters
+        """
+        with self._lock:
+            depths = [len(pending) for pending in self._queues.values()]
+        return {
+            "sockets_queued": len(depths),
+            "queue_depth": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+            "frames": self.frames,
+            "events": self.events,
+        }
+
+    def _run(self, server) -> None:
+        while True:
+            server.sleep(self.window_ms / 1000)
+            self.flush()
+
+    def start(self, server) -> None:
+        """Starts the flush loop, once
+
+        Args:
+            server (SocketIO): Runs the background task
+        """
+        with self._lock:
+            if self._started or self.window_ms <= 0:
+                return
+            self._started = True
+        server.start_background_task(self._run, server)
+
+
+# Dispatcher shared by the worker
+dispatcher = OutboundDispatcher()
+
+
+def _local_emit(manager, base, event, data, namespace, room, skip_sid, callback):
+    """Hands an emit to the dispatcher, or to base when it can't be batched"""
+    if callback is not None or not dispatcher.active or dispatcher.manager is not manager:
+        return base(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback)
+    if isinstance(data, tuple):
+        data = list(data)
+    elif data is not None:
+        data = [data]
+    else:
+        data = []
+    return dispatcher.enqueue(event, data, namespace, room=room, skip_sid=skip_sid)
+
+
+class BatchingManager(socketio.Manager):
+    """Single process client manager that batches through the dispatcher"""
+
+    def initialize(self):
+        super().initialize()
+        dispatcher.manager = self
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None,
+             callback=None, to=None, **kwargs):
+        base = super().emit
+        return _local_emit(self, base, event, data, namespace, to or room, skip_sid, callback)
+
+
+class BatchingRedisManager(socketio.RedisManager):
+    """Redis message queue client manager that batches local deliveries"""
+
+    def initialize(self):
+        super().initialize()
+        dispatcher.manager = self
+
+    def _handle_emit(self, message):
+        if message.get("callback") is not None:
+            return super()._handle_emit(message)
+        base = socketio.Manager.emit.__get__(self)
+        return _local_emit(
+            self,
+            base,
+            message["event"],
+            message["data"],
+            message.get("namespace"),
+            message.get("room"),
+            message.get("skip_sid"),
+            None,
+        )
+
+
+def client_manager(url: str | None, channel: str = "flask-socketio"):
+    """Builds the Socket.IO client manager
+
+    Args:
+        url (str, optional): Redis message queue, None for a single process
+        channel (str, optional): The pub/sub channel. Defaults to flask-socketio's.
+
+    Returns:
+        Manager: The client manager
+    """
+    if url:
+        return BatchingRedisManager(url, channel=channel)
+    return BatchingManager()
@@ -0,0 +1,129 @@
+"""
+Persistence
+
+Batched, atomic writes over the redis client. A UnitOfWork queues the
+writes of several objects on one MULTI/EXEC pipeline; multi-key checks
+that must not race run as Lua scripts.
+
+Sending a message is one script: it appends to the chat's log and reads
+the members to update their inboxes in the same step, so a member added
+or removed meanwhile can't be missed or written wrongly. The script
+builds the inbox key names from the members it reads, which only works
+on a single redis node, not a cluster.
+"""
+from service.common import inbox, message_log
+from service.common.redis_data import r
+
+# Reserves a username and stores the user hash only if the name was free
+_RESERVE_USERNAME = r.register_script(
+    """
+    if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+        return 0
+    end
+    redis.call('HSET', KEYS[2], unpack(ARGV, 3))
+    return 1
+    """
+)
+
+
+# Appends a message and updates every member's inbox and the chat preview
+# KEYS: sequence counter, stream, members set, chat hash
+# ARGV: chat id, sender id, sent time, preview, then stream field value pairs
+# Returns: {entry id, seq}
+_APPEND_MESSAGE = r.register_script(
+    """
+    local seq = redis.call('INCR', KEYS[1])
+    local entry_id = redis.call('XADD', KEYS[2], '*', 'seq', seq, unpack(ARGV, 5))
+    for _, member in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+        redis.call('ZADD', 'inbox:' .. member, ARGV[3], ARGV[1])
+        if member ~= ARGV[2] then
+            redis.call('HINCRBY', 'unread:' .. member, ARGV[1], 1)
+        end
+    end
+    redis.call('HSET', KEYS[4], 'last_time', ARGV[3], 'last_user', ARGV[2],
+               'last_content', ARGV[4])
+    return {entry_id, seq}
+    """
+)
+
+
+def append_message(chat_id: str, message: dict) -> tuple[str, int]:
+    """Appends a message to a chat's log and its members' inboxes, in one round trip
+
+    Args:
+        chat_id (str): The id of the chat
+        message (dict): The serialized message
+
+    Returns:
+        tuple[str, int]: The stream entry id of the message and its seq
+    """
+    content = "" if message.get("content") is None else str(message["content"])
+    args = [chat_id, str(message["user"]), message["sent_time"], content[:inbox.PREVIEW_LENGTH]]
+    for field, value in message_log.to_fields(message).items():
+        args.extend((field, value))
+    cursor, seq = _APPEND_MESSAGE(
+        keys=[
+            message_log.seq_key(chat_id),
+            message_log.stream_key(chat_id),
+            inbox.members_key(chat_id),
+            f"chats:{chat_id}",
+        ],
+        args=args,
+    )
+    return cursor, int(seq)
+
+
+def reserve_username(username: str, user_id: str, user_key: str, fields: dict) -> bool:
+    """Atomically claims a username and writes the user hash
+
+    Args:
+        username (str): The username to claim
+        user_id (str): The id of the user claiming it
+        user_key (str): The redis key of the user hash
+        fields (dict): The fields of the user hash
+
+    Returns:
+        bool: False if the username was already taken
+    """
+    args = [username, user_id]
+    for field, value in fields.items():
+        args.extend((field, value))
+    return bool(_RESERVE_USERNAME(keys=["usernames", user_key], args=args))
+
+
+class UnitOfWork:
+    """Queues writes and sends them in a single MULTI/EXEC round trip
+
+    Usage:
+        with UnitOfWork() as uow:
+            user.add_chat(chat.id, uow.pipe)
+            chat.push_to_redis(uow.pipe)
+    """
+
+    def __init__(self, client=None):
+        """The constructor
+
+        Args:
+            client (Redis, optional): The client to pipeline on. Defaults to r.
+        """
+        self.pipe = (r if client is None else client).pipeline(transaction=True)
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.pipe.reset()
+        return False
+
+    def commit(self) -> list:
+        """Sends every queued write
+
+        Returns:
+            list: The reply of each queued command
+        """
+        self.results = self.pipe.execute()
+        return self.results
@@ -0,0 +1,199 @@
+"""
+Presence
+
+Tracks who is online. Sockets mark their user online on connect, keep
+it fresh with heartbeats and mark it offline on disconnect; a sweep
+expires users whose heartbeats stopped, e.g. when a worker died, and a
+later heartbeat brings them back online.
+
+Each user's open sockets are a set of socket ids rather than a count, so
+a sweep can drop them all: live sockets add themselves back on their
+next heartbeat, and closing a socket the sweep already dropped can't
+take the user offline while another one is open.
+
+Transitions are not sent one by one: each worker collects them and,
+every flush interval, sends each affected friend a single ``presence``
+event listing every change since the last flush.
+"""
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from service.common.redis_data import r
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "presence:online"  # user id -> last heartbeat
+LAST_SEEN = "presence:last_seen"  # user id -> when they went offline
+
+# Seconds without a heartbeat before a user counts as offline
+TIMEOUT = 60
+# Seconds between batched presence events
+FLUSH_INTERVAL = 2
+
+# Removes a socket, going offline when it was the user's last
+# KEYS: the user's sockets, online, last seen
+# ARGV: user id, socket id, now
+_DISCONNECT = r.register_script(
+    """
+    redis.call('SREM', KEYS[1], ARGV[2])
+    if redis.call('SCARD', KEYS[1]) > 0 then
+        return 0
+    end
+    redis.call('ZADD', KEYS[3], ARGV[3], ARGV[1])
+    return redis.call('ZREM', KEYS[2], ARGV[1])
+    """
+)
+
+
+def sockets_key(user_id: str) -> str:
+    """Gets the key of the set of a user's open socket ids"""
+    return f"presence:sockets:{user_id}"
+
+
+def user_room(user_id: str) -> str:
+    """Gets the Socket.IO room every socket of a user joins
+
+    Args:
+        user_id (str): The id of the user
+
+    Returns:
+        str: The room name
+    """
+    return f"users:{user_id}"
+
+
+class PresenceTracker:
+    """Records presence in redis and batches transitions for friends"""
+
+    def __init__(self):
+        self.timeout = TIMEOUT
+        self.flush_interval = FLUSH_INTERVAL
+        self._changes = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _record(self, user_id: str, status: str) -> None:
+        with self._lock:
+            self._changes[user_id] = status
+
+    def connect(self, user_id: str, sid: str) -> None:
+        """Marks a socket of the user as open
+
+        Args:
+            user_id (str): The id of the user
+            sid (str): The id of the socket
+        """
+        self.heartbeat(user_id, sid)
+
+    def heartbeat(self, user_id: str, sid: str) -> None:
+        """Refreshes the user's last heartbeat
+
+        Adds the socket back and marks the user online again if a sweep
+        took them offline
+
+        Args:
+            user_id (str): The id of the user
+            sid (str): The id of the socket
+        """
+        pipe = r.pipeline(transaction=True)
+        pipe.sadd(sockets_key(user_id), sid)
+        pipe.zadd(ONLINE, {user_id: time.time()})
+        _, added = pipe.execute()
+        if added:
+            self._record(user_id, "online")
+
+    def disconnect(self, user_id: str, sid: str) -> None:
+        """Marks a socket of the user as closed
+
+        Args:
+            user_id (str): The id of the user
+            sid (str): The id of the socket
+        """
+        if _DISCONNECT(
+            keys=[sockets_key(user_id), ONLINE, LAST_SEEN], args=[user_id, sid, time.time()]
+        ):
+            self._record(user_id, "offline")
+
+    def sweep(self) -> None:
+        """Takes users whose heartbeats stopped offline
+
+        Every worker sweeps; ZREM decides which one reports the transition
+        """
+        now = time.time()
+        for user_id in r.zrangebyscore(ONLINE, "-inf", now - self.timeout):
+            pipe = r.pipeline(transaction=True)
+            pipe.zrem(ONLINE, user_id)
+            pipe.delete(sockets_key(user_id))
+            pipe.zadd(LAST_SEEN, {user_id: now})
+            removed, _, _ = pipe.execute()
+            if removed:
+                self._record(user_id, "offline")
+
+    def online(self, user_ids: list[str]) -> dict:
+        """Gets who of user_ids is online, in one round trip
+
+        Returns:
+            dict: user id -> True if online
+        """
+        if not user_ids:
+            return {}
+        scores = r.zmscore(ONLINE, user_ids)
+        cutoff = time.time() - self.timeout
+        return {
+            user_id: score is not None and score >= cutoff
+            for user_id, score in zip(user_ids, scores)
+        }
+
+    def take_changes(self) -> dict:
+        """Gets and clears the transitions since the last call"""
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        return changes
+
+    def flush(self, socketio, load_friends) -> None:
+        """Sends each friend one event with all the changes they care about
+
+        Args:
+            socketio (SocketIO): Emits the events
+            load_friends (Callable): Maps user ids to their friend ids
+        """
+        changes = self.take_changes()
+        if not changes:
+            return
+        batches = {}
+        for user_id, friends in load_friends(list(changes)).items():
+            for friend_id in friends:
+                batches.setdefault(friend_id, []).append(
+                    {"user_id": user_id, "status": changes[user_id]}
+                )
+        for friend_id, batch in batches.items():
+            socketio.emit("presence", batch, to=user_room(friend_id))
+
+    def _run(self, socketio, load_friends) -> None:
+        while True:
+            socketio.sleep(self.flush_interval)
+            try:
+                self.sweep()
+                self.flush(socketio, load_friends)
+            except RedisError as error:
+                logger.warning("Presence flush failed: %s", error)
+
+    def start(self, socketio, load_friends) -> None:
+        """Starts the sweep and flush loop, once
+
+        Args:
+            socketio (SocketIO): Emits the events
+            load_friends (Callable): Maps user ids to their friend ids
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._run, socketio, load_friends)
+
+
+# Tracker shared by the worker
+tracker = PresenceTracker()
@@ -0,0 +1,157 @@
+"""
+Rate Limit
+
+Token bucket rate limits shared by every worker. All buckets of a check
+are tested and charged in one atomic Lua script, so a check costs a
+single redis round trip. Checks fail open when redis is unreachable.
+"""
+from dataclasses import dataclass
+from functools import wraps
+from typing import Callable
+
+from flask import request
+from flask_socketio import emit
+from redis.exceptions import RedisError
+
+from service.common import status
+from service.common.redis_data import r
+
+# KEYS: one bucket per limit
+# ARGV: cost, then capacity and refill per second for each bucket
+# Returns: {1, 0} when allowed, {0, ms until allowed} otherwise
+_TOKEN_BUCKET = r.register_script(
+    """
+    local now = redis.call('TIME')
+    local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    local cost = tonumber(ARGV[1])
+    local tokens = {}
+    local wait_ms = 0
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[i * 2])
+        local rate = tonumber(ARGV[i * 2 + 1])
+        local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+        local level = tonumber(bucket[1]) or capacity
+        local ts = tonumber(bucket[2]) or now_ms
+        level = math.min(capacity, level + (now_ms - ts) * rate / 1000)
+        tokens[i] = level
+        if level < cost then
+            wait_ms = math.max(wait_ms, math.ceil((cost - level) * 1000 / rate))
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[i * 2])
+        local rate = tonumber(ARGV[i * 2 + 1])
+        local level = tokens[i]
+        if wait_ms == 0 then
+            level = level - cost
+        end
+        redis.call('HSET', key, 'tokens', level, 'ts', now_ms)
+        redis.call('PEXPIRE', key, math.ceil(capacity * 1000 / rate))
+    end
+    if wait_ms > 0 then
+        return {0, wait_ms}
+    end
+    return {1, 0}
+    """
+)
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """A token bucket: capacity requests, refilled over per_seconds
+
+    Attributes:
+        name (str): Names the bucket in redis
+        capacity (int): Burst size
+        per_seconds (float): Seconds to refill a full bucket
+        key (Callable): Returns the identity to limit, or None to skip
+    """
+
+    name: str
+    capacity: int
+    per_seconds: float
+    key: Callable[[], str | None]
+
+    @property
+    def rate(self) -> float:
+        """Tokens added per second"""
+        return self.capacity / self.per_seconds
+
+
+def by_ip() -> str | None:
+    """Limits by client address"""
+    return request.remote_addr
+
+
+def by_form(field: str) -> Callable[[], str | None]:
+    """Limits by a submitted form field, e.g. the username"""
+    return lambda: request.form.get(field) or None
+
+
+def by_sid() -> str | None:
+    """Limits by Socket.IO session"""
+    return getattr(request, "sid", None)
+
+
+def check(limits: tuple[RateLimit, ...], cost: int = 1) -> float:
+    """Charges every limit that applies to the current request
+
+    Args:
+        limits (tuple[RateLimit, ...]): The limits
+        cost (int, optional): Tokens to take. Defaults to 1.
+
+    Returns:
+        float: 0 if allowed, otherwise seconds until the request would be
+    """
+    keys = []
+    args = [cost]
+    for limit in limits:
+        identity = limit.key()
+        if identity is None:
+            continue
+        keys.append(f"ratelimit:{limit.name}:{identity}")
+        args.extend((limit.capacity, limit.rate))
+    if not keys:
+        return 0
+    try:
+        allowed, wait_ms = _TOKEN_BUCKET(keys=keys, args=args)
+    except RedisError:
+        return 0
+    return 0 if allowed else wait_ms / 1000
+
+
+def limit_route(*limits: RateLimit):
+    """Decorates a flask view, answering 429 when over a limit"""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            wait = check(limits)
+            if wait:
+                return (
+                    "Too many requests",
+                    status.HTTP_429_TOO_MANY_REQUESTS,
+                    {"Retry-After": str(max(1, round(wait)))},
+                )
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def limit_socket(*limits: RateLimit):
+    """Decorates a Socket.IO handler, emitting an error event when over a limit"""
+
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            wait = check(limits)
+            if wait:
+                emit("error", {"error": "rate_limited", "retry_after": wait})
+                return None
+            return handler(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
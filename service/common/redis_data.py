@@ -1,4 +1,61 @@
 """Redis data"""
+import os
+import time
+
 import redis
+from redis.client import Pipeline
+
+from service.common.metrics import REDIS_COMMANDS, REDIS_ERRORS
+
+# Shared by the data layer and the Socket.IO message queue
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis-stack:6379/0")
+
+# Set SOCKETIO_MESSAGE_QUEUE to an empty string for a single process
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE", REDIS_URL) or None
+
+
+def _timed(command: tuple, call, *args, **options):
+    """Runs one round trip, observing its latency and errors under command"""
+    start = time.perf_counter()
+    try:
+        return call(*args, **options)
+    except redis.RedisError:
+        REDIS_ERRORS.inc(command)
+        raise
+    finally:
+        REDIS_COMMANDS.observe(command, time.perf_counter() - start)
+
+
+class InstrumentedPipeline(Pipeline):
+    """Pipeline that times each execute as one round trip
+
+    Commands sent ahead of the batch count as their own round trips,
+    e.g. the SCRIPT EXISTS that execute sends when scripts are queued
+    """
+
+    def execute(self, raise_on_error=True):
+        command = ("multi",) if self.transaction else ("pipeline",)
+        return _timed(command, super().execute, raise_on_error)
+
+    def immediate_execute_command(self, *args, **options):
+        command = (str(args[0]).lower(),)
+        return _timed(command, super().immediate_execute_command, *args, **options)
+
+
+class InstrumentedRedis(redis.StrictRedis):
+    """Client that times every command by name"""
+
+    def execute_command(self, *args, **options):
+        command = (str(args[0]).lower(),)
+        return _timed(command, super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+r = InstrumentedRedis.from_url(REDIS_URL, decode_responses=True)
 
-r = redis.StrictRedis(host='redis-stack', port=6379, db=0, decode_responses=True)
+# Returns raw bytes, for values stored in the binary codec format
+rb = InstrumentedRedis.from_url(REDIS_URL)
@@ -0,0 +1,157 @@
+"""
+Sessions
+
+Session interfaces that work across several workers: signed cookies
+accepting a list of rotated secret keys, and optional server-side
+sessions stored in Redis. Server-side sessions get a new id on login,
+so an id planted before it is worthless afterwards.
+"""
+import secrets
+
+from flask import session as current_session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer, URLSafeTimedSerializer
+from werkzeug.datastructures import CallbackDict
+
+from service.common.redis_data import r
+
+
+def signing_keys(app) -> list:
+    """Gets every key a signature may be made with, newest last
+
+    Args:
+        app (Flask): The app
+
+    Returns:
+        list: The fallback keys followed by the current SECRET_KEY
+    """
+    return [*app.config.get("SECRET_KEY_FALLBACKS", []), app.secret_key]
+
+
+class RotatingCookieSessionInterface(SecureCookieSessionInterface):
+    """Cookie sessions signed with SECRET_KEY and still readable with any
+    key in SECRET_KEY_FALLBACKS"""
+
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            return None
+        signer_kwargs = {
+            "key_derivation": self.key_derivation,
+            "digest_method": self.digest_method,
+        }
+        return URLSafeTimedSerializer(
+            signing_keys(app),
+            salt=self.salt,
+            serializer=self.serializer,
+            signer_kwargs=signer_kwargs,
+        )
+
+
+class RedisSession(CallbackDict, SessionMixin):
+    """A session whose data lives in redis under its sid"""
+
+    def __init__(self, initial=None, sid="", new=False):
+        def on_update(session):
+            session.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self) -> None:
+        """Moves the session to a new id, the old one is deleted on save"""
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+def regenerate_session(sender=None, **extra) -> None:  # pylint: disable=unused-argument
+    """Gives a server-side session a new id, connected to user_logged_in"""
+    regenerate = getattr(current_session, "regenerate", None)
+    if regenerate is not None:
+        regenerate()
+
+
+class RedisSessionInterface(SessionInterface):
+    """Server-side sessions, the cookie only carries a signed session id"""
+
+    serializer = TaggedJSONSerializer()
+    session_class = RedisSession
+    salt = "wesmes-session"
+    key_prefix = "sessions:"
+
+    def _signer(self, app) -> Signer:
+        return Signer(signing_keys(app), salt=self.salt)
+
+    def _ttl(self, app, session) -> int:
+        if session.permanent:
+            return int(app.permanent_session_lifetime.total_seconds())
+        return int(app.config.get("SESSION_REDIS_TTL", 86400))
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = r.get(self.key_prefix + sid)
+                if data is not None:
+                    return self.session_class(self.serializer.loads(data), sid=sid)
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if session.previous_sid is not None:
+            r.delete(self.key_prefix + session.previous_sid)
+            session.previous_sid = None
+
+        if not session:
+            if session.modified:
+                r.delete(self.key_prefix + session.sid)
+                response.delete_cookie(
+                    name,
+                    domain=domain,
+                    path=path,
+                    secure=secure,
+                    samesite=samesite,
+                    httponly=httponly,
+                )
+                response.vary.add("Cookie")
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        r.setex(
+            self.key_prefix + session.sid,
+            self._ttl(app, session),
+            self.serializer.dumps(dict(session)),
+        )
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=httponly,
+            domain=domain,
+            path=path,
+            secure=secure,
+            samesite=samesite,
+        )
+        response.vary.add("Cookie")
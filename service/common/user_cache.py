@@ -0,0 +1,151 @@
+"""
+User Cache
+
+A bounded LRU cache with a TTL of deserialized users, kept in each
+worker. Writes publish the user id on a redis channel so every worker
+drops its stale copy.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+from service.common.redis_data import r
+
+INVALIDATION_CHANNEL = "users:invalidate"
+
+
+class UserCache:
+    """LRU + TTL cache of user objects"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        """The constructor
+
+        Args:
+            maxsize (int, optional): Max number of cached users. Defaults to 1024.
+            ttl (float, optional): Seconds an entry stays valid. Defaults to 30.0.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _clone(user):
+        """Copies a user so callers can mutate it without touching the cache"""
+        clone = copy.copy(user)
+        for name in getattr(type(user), "__slots__", ()):
+            value = getattr(user, name, None)
+            if isinstance(value, (list, set)):
+                setattr(clone, name, type(value)(value))
+        for name, value in getattr(user, "__dict__", {}).items():
+            if isinstance(value, (list, set)):
+                setattr(clone, name, type(value)(value))
+        return clone
+
+    def get(self, user_id: str):
+        """Gets a cached user
+
+        Args:
+            user_id (str): The id of the user
+
+        Returns:
+            User: A copy of the cached user, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            user = entry[1]
+        return self._clone(user)
+
+    def put(self, user_id: str, user) -> None:
+        """Caches a user
+
+        Args:
+            user_id (str): The id of the user
+            user (User): The user
+        """
+        if self.maxsize <= 0:
+            return
+        entry = (time.monotonic() + self.ttl, self._clone(user))
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        """Drops a user from this worker's cache"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        """Drops every user from this worker's cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Gets the cache counters
+
+        Returns:
+            dict: The hits, misses and current size
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+# Cache shared by the worker
+user_cache = UserCache()
+
+
+def invalidate(user_id: str, client=None) -> None:
+    """Drops a user from the cache of every worker
+
+    Args:
+        user_id (str): The id of the user
+        client (Redis, optional): Client or pipeline to queue the publish on
+    """
+    user_cache.invalidate(user_id)
+    client = r if client is None else client
+    client.publish(INVALIDATION_CHANNEL, user_id)
+
+
+def _listen(retry_delay: float) -> None:
+    """Applies invalidations published by other workers"""
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Invalidations sent while disconnected were missed
+            user_cache.clear()
+            for message in pubsub.listen():
+                if message["type"] == "message":
+                    user_cache.invalidate(message["data"])
+        except RedisError:
+            user_cache.clear()
+            time.sleep(retry_delay)
+
+
+def start_listener(retry_delay: float = 1.0) -> threading.Thread:
+    """Starts the invalidation listener in a daemon thread
+
+    Args:
+        retry_delay (float, optional): Seconds to wait before reconnecting
+
+    Returns:
+        threading.Thread: The listener thread
+    """
+    thread = threading.Thread(
+        target=_listen, args=(retry_delay,), name="user-cache-invalidation", daemon=True
+    )
+    thread.start()
+    return thread
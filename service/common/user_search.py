@@ -0,0 +1,193 @@
+"""
+User Search
+
+Type-ahead search over usernames. Prefix matches come from a sorted set
+with every score at 0, queried with ZRANGEBYLEX in O(log N + M).
+Fuzzy matches use RediSearch when the server has it (redis-stack), or
+rank a bounded set of prefix candidates by edit distance in Python.
+"""
+import re
+
+from redis.commands.search.field import TextField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from redis.exceptions import RedisError, ResponseError
+
+from service.common.redis_data import r
+
+LEX_INDEX = "usernames:lex"
+HANDLE_PREFIX = "handles:"
+SEARCH_INDEX = "idx:handles"
+
+# Separates the lowercased sort key from the username in LEX_INDEX
+_SEPARATOR = "\x00"
+
+# Candidates ranked by the pure-Python fuzzy fallback
+FALLBACK_CANDIDATES = 200
+
+_SEARCH_SPECIAL = re.compile(r"([^\w])")
+
+# Result of the last successful module probe, None until there is one
+_has_search = None
+
+
+def has_search() -> bool:
+    """Checks if the server has the RediSearch module
+
+    The answer is kept once the server gives one, an error reply counts as
+    no module. A probe that fails to reach the server counts as no module
+    and is retried on the next call
+    """
+    global _has_search  # pylint: disable=global-statement
+    if _has_search is None:
+        try:
+            modules = r.module_list()
+        except ResponseError:
+            modules = []
+        except RedisError:
+            return False
+        _has_search = any(module.get("name") in ("search", "ft") for module in modules)
+    return _has_search
+
+
+def create_search_index() -> None:
+    """Creates the RediSearch index if the module is there"""
+    if not has_search():
+        return
+    try:
+        r.ft(SEARCH_INDEX).create_index(
+            [TextField("username", sortable=True)],
+            definition=IndexDefinition(prefix=[HANDLE_PREFIX], index_type=IndexType.HASH),
+        )
+    except ResponseError as error:
+        if "already exists" not in str(error):
+            raise
+
+
+def index_username(username: str, user_id: str, client=None) -> None:
+    """Adds a username to the search indexes
+
+    Args:
+        username (str): The username
+        user_id (str): The id of the user
+        client (Redis, optional): Client or pipeline to queue the writes on
+    """
+    client = r if client is None else client
+    client.zadd(LEX_INDEX, {f"{username.lower()}{_SEPARATOR}{username}": 0})
+    if has_search():
+        client.hset(f"{HANDLE_PREFIX}{username}", mapping={"username": username, "id": user_id})
+
+
+def rebuild() -> int:
+    """Indexes every username in the usernames hash
+
+    Returns:
+        int: The number of usernames indexed
+    """
+    create_search_index()
+    indexed = 0
+    pipe = r.pipeline(transaction=False)
+    for username, user_id in r.hscan_iter("usernames"):
+        index_username(username, user_id, pipe)
+        indexed += 1
+        if indexed % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+    return indexed
+
+
+def prefix(query: str, limit: int = 10) -> list[str]:
+    """Finds usernames starting with query, case insensitive
+
+    Args:
+        query (str): The start of the username
+        limit (int, optional): Max results. Defaults to 10.
+
+    Returns:
+        list[str]: The usernames, in lexicographic order
+    """
+    start = query.lower().encode()
+    # 0xff never occurs in UTF-8, so it sorts after every continuation
+    members = r.zrangebylex(LEX_INDEX, b"[" + start, b"[" + start + b"\xff", start=0, num=limit)
+    return [member.split(_SEPARATOR, 1)[1] for member in members]
+
+
+def _edit_distance(first: str, second: str) -> int:
+    """Levenshtein distance"""
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (first_char != second_char),
+            ))
+        previous = current
+    return previous[-1]
+
+
+def _fuzzy_search(query: str, limit: int) -> list[str]:
+    """Fuzzy matches through RediSearch"""
+    term = _SEARCH_SPECIAL.sub(r"\\\1", query.lower())
+    result = r.ft(SEARCH_INDEX).search(
+        Query(f"%{term}%").return_fields("username").paging(0, limit)
+    )
+    return [document.username for document in result.docs]
+
+
+def _candidate_prefixes(lowered: str) -> list[str]:
+    """Gets what a username may start with if the query has one typo up front
+
+    The query's first two characters, and what they are with an extra
+    first or second character removed or the two swapped. Substituted
+    characters up front are not covered, RediSearch finds those
+    """
+    prefixes = [lowered[:2], lowered[1:3], lowered[0] + lowered[2], lowered[1] + lowered[0]]
+    return list(dict.fromkeys(prefixes))
+
+
+def _fuzzy_fallback(query: str, limit: int) -> list[str]:
+    """Ranks usernames by edit distance, among those with a candidate prefix"""
+    lowered = query.lower()
+    prefixes = _candidate_prefixes(lowered)
+    scored = {}
+    for start in prefixes:
+        for username in prefix(start, FALLBACK_CANDIDATES // len(prefixes)):
+            distance = _edit_distance(lowered, username.lower()[:len(lowered)])
+            if distance <= 2:
+                scored[username] = distance
+    ranked = sorted((distance, username) for username, distance in scored.items())
+    return [username for _, username in ranked[:limit]]
+
+
+def search(query: str, limit: int = 10) -> list[str]:
+    """Finds usernames for a type-ahead box
+
+    Prefix matches come first, fuzzy matches fill the rest
+
+    Args:
+        query (str): What the user typed
+        limit (int, optional): Max results. Defaults to 10.
+
+    Returns:
+        list[str]: The usernames
+    """
+    query = query.strip()
+    if not query:
+        return []
+    results = prefix(query, limit)
+    if len(results) >= limit or len(query) < 3:
+        return results
+    try:
+        fuzzy = _fuzzy_search(query, limit) if has_search() else _fuzzy_fallback(query, limit)
+    except ResponseError:
+        fuzzy = _fuzzy_fallback(query, limit)
+    for username in fuzzy:
+        if username not in results:
+            results.append(username)
+    return results[:limit]
+
+
+if __name__ == "__main__":
+    print(f"Indexed {rebuild()} usernames")
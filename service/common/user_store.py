@@ -0,0 +1,194 @@
+"""
+User Store
+
+Users stored field by field instead of as one serialized record:
+
+    users:{user_id}        hash of the scalar fields plus a version
+    users:{user_id}:chats  set of chat ids
+
+Updates write only the fields that changed. Every write of the hash
+bumps the version; conditional updates check it in the same Lua script,
+so a writer holding a stale copy gets a conflict instead of silently
+overwriting someone else's change. Adding a chat is a SADD, which
+concurrent writers can't clobber, so it leaves the version alone.
+
+Records in the old serialized format are migrated when a worker starts,
+see migrate_on_startup.
+"""
+from service.common import codec
+from service.common.redis_data import r, rb
+
+# Scalar fields kept in the user hash
+FIELDS = ("id", "email", "username", "name", "password", "profile_pic_link")
+
+# Storage order of the serialized records users were kept in before
+LEGACY_FIELDS = FIELDS + ("chats", "friends", "pending_friends", "sent_friends")
+
+# Set once no serialized records are left
+MIGRATED = "migrations:user_hashes"
+
+# Writes fields and adds chats, returns the new version
+# KEYS: user hash, chat set
+# ARGV: field value pairs, then chat ids; the number of field values first
+_WRITE = r.register_script(
+    """
+    local values = tonumber(ARGV[1])
+    if values > 0 then
+        redis.call('HSET', KEYS[1], unpack(ARGV, 2, values + 1))
+    end
+    if #ARGV > values + 1 then
+        redis.call('SADD', KEYS[2], unpack(ARGV, values + 2))
+    end
+    return redis.call('HINCRBY', KEYS[1], 'version', 1)
+    """
+)
+
+# Writes fields if the version still matches, returns the new version or nil
+# KEYS: user hash
+# ARGV: expected version, then field value pairs
+_UPDATE = r.register_script(
+    """
+    local version = redis.call('HGET', KEYS[1], 'version')
+    if not version or version ~= ARGV[1] then
+        return false
+    end
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+    return redis.call('HINCRBY', KEYS[1], 'version', 1)
+    """
+)
+
+
+def user_key(user_id: str) -> str:
+    """Gets the key of a user's hash"""
+    return f"users:{user_id}"
+
+
+def chats_key(user_id: str) -> str:
+    """Gets the key of a user's chat set"""
+    return f"users:{user_id}:chats"
+
+
+def write(user_id: str, fields: dict, chats=(), client=None) -> int:
+    """Writes fields and adds chats without checking the version, in one round trip
+
+    Args:
+        user_id (str): The id of the user
+        fields (dict): The fields to write
+        chats (Iterable[str], optional): Chat ids to add
+        client (Redis, optional): Client or pipeline to queue the script on
+
+    Returns:
+        int: The new version, from execute when queued on a pipeline
+    """
+    args = [2 * len(fields)]
+    for field, value in fields.items():
+        args.extend((field, value))
+    args.extend(chats)
+    return _WRITE(
+        keys=[user_key(user_id), chats_key(user_id)],
+        args=args,
+        client=r if client is None else client,
+    )
+
+
+def update(user_id: str, fields: dict, version: int) -> int | None:
+    """Writes fields if nobody changed the user since version, in one round trip
+
+    Args:
+        user_id (str): The id of the user
+        fields (dict): The fields to write
+        version (int): The version the caller loaded
+
+    Returns:
+        int: The new version, or None on a conflict or if the user is gone
+    """
+    args = [version]
+    for field, value in fields.items():
+        args.extend((field, value))
+    return _UPDATE(keys=[user_key(user_id)], args=args)
+
+
+def add_chat(user_id: str, chat_id: str, client=None) -> None:
+    """Adds a chat to a user, safe against concurrent writers
+
+    Args:
+        user_id (str): The id of the user
+        chat_id (str): The id of the chat
+        client (Redis, optional): Client or pipeline to queue the write on
+    """
+    client = r if client is None else client
+    client.sadd(chats_key(user_id), chat_id)
+
+
+def load_many(user_ids: list[str]) -> list[tuple[dict, set[str]] | None]:
+    """Reads the fields and chats of several users in one round trip
+
+    Args:
+        user_ids (list[str]): The ids of the users
+
+    Returns:
+        list: (fields, chats) per user, or None for users that don't exist
+    """
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hgetall(user_key(user_id))
+        pipe.smembers(chats_key(user_id))
+    replies = pipe.execute()
+    return [
+        (fields, chats) if fields else None
+        for fields, chats in zip(replies[::2], replies[1::2])
+    ]
+
+
+def migrate_records() -> int:
+    """Moves users from serialized records into hashes and chat sets
+
+    Run the friends migration first, it reads the old records
+
+    Returns:
+        int: The number of users migrated
+    """
+    migrated = 0
+    for key in r.scan_iter(match="users:*", _type="string"):
+        raw = rb.get(key)
+        if not raw:
+            continue
+        data = codec.decode_record(LEGACY_FIELDS, raw)
+        chats = [chat_id for chat_id in data.get("chats") or [] if isinstance(chat_id, str)]
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(key)
+        write(
+            key.split(":", 1)[1],
+            {field: str(data.get(field) or "") for field in FIELDS},
+            chats,
+            pipe,
+        )
+        pipe.execute()
+        migrated += 1
+    return migrated
+
+
+def migrate_on_startup() -> int:
+    """Migrates the serialized records left, unless a worker already did
+
+    Copies the friend lists out of each record first. Workers starting
+    together may both migrate; each record is moved in one transaction
+    and its friend lists are copied before any record is moved, so no
+    record is lost.
+
+    Returns:
+        int: The number of users migrated
+    """
+    if r.exists(MIGRATED):
+        return 0
+    # Imported here, friends reads LEGACY_FIELDS from this module
+    from service.common import friends  # pylint: disable=import-outside-toplevel
+
+    friends.migrate_user_lists()
+    migrated = migrate_records()
+    r.set(MIGRATED, 1)
+    return migrated
+
+
+if __name__ == "__main__":
+    print(f"Migrated {migrate_records()} users")
@@ -1,6 +1,6 @@
 """The app routes"""
-from flask import render_template, Flask, request, flash, redirect, url_for
-from flask_socketio import send, SocketIO
+from flask import render_template, Flask, request, flash, redirect, url_for, jsonify, Response
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_login import (
     LoginManager,
     login_user,
@@ -13,14 +13,42 @@ from flask_login import (
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # User Class
-from service.classes import User, Chat, Message
+from service.classes import User, Chat, Message, ConflictError
 
 # Redis object
-from service.common.redis_data import r
+from service.common.redis_data import r, SOCKETIO_MESSAGE_QUEUE
+from service.common import status
+from service.common.user_cache import user_cache
+from service.common.persistence import UnitOfWork
+from service.common import (
+    delivery,
+    friends,
+    hashing,
+    inbox,
+    message_log,
+    message_search,
+    metrics,
+    outbound,
+    user_search,
+)
+from service.common.presence import tracker, user_room
+from service.common.rate_limit import (
+    RateLimit,
+    by_form,
+    by_ip,
+    by_sid,
+    limit_route,
+    limit_socket,
+)
 
 # Global/Enivironment variables
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Emits go through the Redis message queue so every worker reaches every room
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    client_manager=outbound.client_manager(SOCKETIO_MESSAGE_QUEUE),
+)
 login_manager = LoginManager()
 
 # Login-Manager init
@@ -35,6 +63,42 @@ login_manager.needs_refresh_message_category = "info"
 login_manager.session_protection = "strong"
 
 
+# History pagination
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+# Rate limits: capacity requests per window, refilled continuously
+LOGIN_LIMITS = (
+    RateLimit("login:ip", 20, 60, by_ip),
+    RateLimit("login:user", 5, 60, by_form("username")),
+)
+SIGNUP_LIMITS = (RateLimit("signup:ip", 5, 300, by_ip),)
+MESSAGE_LIMITS = (RateLimit("message:sid", 20, 10, by_sid),)
+SEARCH_LIMITS = (RateLimit("search:ip", 30, 10, by_ip),)
+FRIEND_LIMITS = (RateLimit("friends:ip", 20, 60, by_ip),)
+
+# Chats listed on the chats page
+INBOX_SIZE = 50
+
+# Type-ahead results
+SEARCH_MAX_RESULTS = 20
+
+# Message search pagination
+MESSAGE_SEARCH_PAGE_SIZE = 20
+MESSAGE_SEARCH_MAX_PAGE_SIZE = 100
+
+# Friends of friends suggested on the friends page
+FRIEND_SUGGESTIONS = 10
+
+# Messages flashed for the outcomes of friends.request
+FRIEND_REQUEST_RESULTS = {
+    "sent": ("Friend request sent", "success"),
+    "pending": ("Friend request already sent", "info"),
+    "accepted": ("You are now friends", "success"),
+    "friends": ("You are already friends", "info"),
+    "self": ("You can't add yourself", "error"),
+}
+
 # For proxies
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
@@ -49,39 +113,178 @@ def get_user_from_handle(handle: str) -> User:
         User: The found user
     """
     user_id = r.hget('usernames', key=handle)
-    return User().pull_from_redis(user_id)
+    return User.load(user_id)
+
+def chat_room(chat_id: str) -> str:
+    """Gets the Socket.IO room of a chat
+
+    Args:
+        chat_id (str): The id of the chat
+
+    Returns:
+        str: The room name
+    """
+    return f"chats:{chat_id}"
+
+def send_message(chat_id: str, content: str, user: str) -> dict:
+    """Appends the message to the chat's log
+
+    Returns:
+        dict: The event payload for the chat's room
+    """
+    updated_chat = Chat.for_id(chat_id)
+    message = Message(user,content)
+    cursor, seq = updated_chat.append_message(message)
+    return {
+        "chat_id": chat_id,
+        "id": message.get_id(),
+        "cursor": cursor,
+        "seq": seq,
+        "user": user,
+        "content": content,
+        "sent_time": message.sent_time,
+    }
+
+@socketio.on("connect")
+@metrics.timed_event("connect")
+def join_chat_rooms(auth=None) -> bool:
+    """Joins the rooms of every chat the user belongs to
+
+    Returns:
+        bool: False to refuse anonymous connections
+    """
+    if not current_user.is_authenticated:
+        return False
+    join_room(user_room(current_user.get_id()))
+    for chat_id in current_user.chats:
+        join_room(chat_room(chat_id))
+    tracker.connect(current_user.get_id(), request.sid)
+    metrics.SOCKET_CONNECTIONS.inc()
+    return True
+
+@socketio.on("disconnect")
+@metrics.timed_event("disconnect")
+def mark_offline() -> None:
+    """Records that one of the user's sockets closed"""
+    if current_user.is_authenticated:
+        tracker.disconnect(current_user.get_id(), request.sid)
+        metrics.SOCKET_CONNECTIONS.dec()
+
+@socketio.on("heartbeat")
+@metrics.timed_event("heartbeat")
+def heartbeat() -> None:
+    """Keeps the user marked online"""
+    if current_user.is_authenticated:
+        tracker.heartbeat(current_user.get_id(), request.sid)
+
+@socketio.on("join")
+@metrics.timed_event("join")
+def join_chat(data: dict) -> None:
+    """Joins the room of a chat the user was added to after connecting
+
+    Args:
+        data (dict): Contains the chat_id
+    """
+    chat_id = (data or {}).get("chat_id")
+    if chat_id not in current_user.chats:
+        emit("error", {"chat_id": chat_id, "error": "Chat not found"})
+        return
+    join_room(chat_room(chat_id))
+
+@socketio.on("leave")
+@metrics.timed_event("leave")
+def leave_chat(data: dict) -> None:
+    """Leaves the room of a chat
+
+    Args:
+        data (dict): Contains the chat_id
+    """
+    leave_room(chat_room((data or {}).get("chat_id")))
+
+@socketio.on("read")
+@metrics.timed_event("read")
+def read_chat(data: dict) -> None:
+    """Clears the unread count of a chat the user is looking at
+
+    Args:
+        data (dict): Contains the chat_id
+    """
+    chat_id = (data or {}).get("chat_id")
+    if chat_id in current_user.chats:
+        inbox.mark_read(current_user.get_id(), chat_id)
+
+@socketio.on("ack")
+@metrics.timed_event("ack")
+def ack_messages(data: dict) -> None:
+    """Records the last message the client received in a chat
+
+    Args:
+        data (dict): Contains the chat_id and cursor
+    """
+    data = data or {}
+    chat_id = data.get("chat_id")
+    if chat_id in current_user.chats:
+        delivery.ack(current_user.get_id(), chat_id, data.get("cursor"))
 
-def send_message(chat_id: str, content: str, user: str):
-    """Sends the message to all the users in the chat"""
-    updated_chat = Chat([],"",[])
-    updated_chat.pull_from_redis(chat_id)
-    updated_chat.messages.append(Message(user,content))
+@socketio.on("resume")
+@metrics.timed_event("resume")
+def resume(data: dict) -> None:
+    """Replays the messages missed while disconnected
+
+    Only the chats named in cursors are replayed, each gets a chat_replay
+    even when nothing was missed so the client knows the resume finished
+
+    Args:
+        data (dict): Contains cursors, chat id -> last cursor the client has.
+            A null cursor resumes from the last ack.
+    """
+    cursors = (data or {}).get("cursors") or {}
+    if not isinstance(cursors, dict):
+        return
+    chat_ids = [chat_id for chat_id in cursors if chat_id in current_user.chats]
+    missed = delivery.replay(current_user.get_id(), chat_ids, cursors)
+    for chat_id in chat_ids:
+        batch = missed.get(chat_id, {"messages": [], "complete": True})
+        emit("chat_replay", {"chat_id": chat_id, **batch})
 
 @socketio.on("message")
-def share_message(message: str) -> None:
-    """Broadcasts message to all users
+@metrics.timed_event("message")
+@limit_socket(*MESSAGE_LIMITS)
+def share_message(data: dict) -> None:
+    """Sends a message to the members of its chat
 
     Args:
-        message (str): Message
+        data (dict): Contains the chat_id and content
     Returns:
         None: nothing
     """
-    send(message, broadcast=True)
-    # send() function will emit a message vent by default
+    if not isinstance(data, dict):
+        emit("error", {"error": "Invalid message"})
+        return
+    chat_id = data.get("chat_id")
+    content = data.get("content")
+    if chat_id not in current_user.chats or not content:
+        emit("error", {"chat_id": chat_id, "error": "Invalid message"})
+        return
+    payload = send_message(chat_id, str(content), current_user.get_id())
+    emit("chat_message", payload, to=chat_room(chat_id))
 
 
 @app.errorhandler(404)
 def not_found(error):
-    """The 404 response"""
-    app.logger.warning(
-        'Client %s connected to %s using method %s but recieved 404 error: %s',
-        request.remote_addr,
-        request.path,
-        request.method,
-        str(error)
-    )
+    """The 404 response, logged by the sampled access log"""
     return render_template("404.html"), 404
 
+@app.errorhandler(hashing.HashingBusyError)
+def hashing_busy(error):
+    """The 503 response when too many passwords are waiting to be hashed"""
+    retry_after = max(1, round(hashing.hasher.timeout or 1))
+    return (
+        "Too many requests, try again shortly",
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {"Retry-After": str(retry_after)},
+    )
+
 @app.errorhandler(500)
 def server_error(error):
     """The 500 response"""
@@ -98,12 +301,6 @@ def server_error(error):
 def index():
     """The root html response
     """
-    app.logger.info(
-        'Client %s connected to %s using method %s',
-        request.remote_addr,
-        request.path,
-        request.method
-    )
     return render_template("index.html", current_user=current_user)
 
 
@@ -111,12 +308,6 @@ def index():
 def signup():
     """The signup page
     """
-    app.logger.info(
-        'Client %s connected to %s using method %s',
-        request.remote_addr,
-        request.path,
-        request.method
-    )
     if current_user.is_authenticated:
         return redirect(url_for('home')),302
     next_arg = request.args.get('next')
@@ -131,6 +322,23 @@ def home():
     return render_template('home.html', current_user = current_user)
 
 
+@app.get('/metrics')
+def metrics_page():
+    """Prometheus metrics of every live worker
+
+    Query args:
+        local (str, optional): Any value to report only this worker
+
+    Returns:
+        Response: The Prometheus text format
+    """
+    if request.args.get('local'):
+        merged = metrics.merge({metrics.worker_name(): metrics.snapshot()})
+    else:
+        merged = metrics.collect_all(metrics.publisher.interval)
+    return Response(metrics.render(merged), mimetype='text/plain; version=0.0.4')
+
+
 @app.get('/login_page')
 def login_page():
     """Login Page"""
@@ -140,11 +348,171 @@ def login_page():
     return render_template('login.html', next = next_arg or url_for('home'),
                            back = '/login_page', current_user=current_user)
 
-@login_required
 @app.get('/chats')
+@login_required
 def chats():
     """Chat page"""
-    return render_template('chat.html')
+    return render_template('chat.html', chats=inbox.top(current_user.get_id(), INBOX_SIZE))
+
+
+@app.get('/chats/<chat_id>')
+@login_required
+def chat(chat_id):
+    """Page for a single chat"""
+    if chat_id not in current_user.chats:
+        return render_template("404.html"), status.HTTP_404_NOT_FOUND
+    inbox.mark_read(current_user.get_id(), chat_id)
+    return render_template('chat.html', chat_id=chat_id)
+
+
+@app.get('/chats/<chat_id>/messages')
+@login_required
+def chat_history(chat_id):
+    """Returns a page of a chat's history, newest page first
+
+    Query args:
+        before (str, optional): Cursor from a previous page
+        limit (int, optional): Page size, capped at HISTORY_MAX_PAGE_SIZE
+
+    Returns:
+        Response: JSON with the messages (oldest first) and the next cursor
+    """
+    if chat_id not in current_user.chats:
+        return jsonify(error="Chat not found"), status.HTTP_404_NOT_FOUND
+    limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    cursor = request.args.get('before') or None
+    if cursor is not None and not message_log.is_cursor(cursor):
+        return jsonify(error="Invalid cursor"), status.HTTP_400_BAD_REQUEST
+
+    history = Chat.for_id(chat_id)
+    page = history.load_messages(cursor, limit)
+
+    next_cursor = page[0]["cursor"] if len(page) == limit else None
+    return jsonify(messages=page, next_cursor=next_cursor), status.HTTP_200_OK
+
+
+@app.get('/users/search')
+@login_required
+@limit_route(*SEARCH_LIMITS)
+def search_users():
+    """Type-ahead search over usernames
+
+    Query args:
+        q (str): What the user typed
+        limit (int, optional): Max results, capped at SEARCH_MAX_RESULTS
+
+    Returns:
+        Response: JSON with the matching usernames
+    """
+    limit = request.args.get('limit', 10, type=int)
+    limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+    query = request.args.get('q', '')
+    return jsonify(users=user_search.search(query, limit)), status.HTTP_200_OK
+
+
+@app.get('/search/messages')
+@login_required
+@limit_route(*SEARCH_LIMITS)
+def search_messages():
+    """Full-text search over the messages of the user's chats
+
+    Query args:
+        q (str): The words to look for
+        page (int, optional): Page number, from 1
+        limit (int, optional): Page size, capped at MESSAGE_SEARCH_MAX_PAGE_SIZE
+
+    Returns:
+        Response: JSON with the total number of hits and the page of hits
+    """
+    limit = request.args.get('limit', MESSAGE_SEARCH_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MESSAGE_SEARCH_MAX_PAGE_SIZE))
+    page = max(1, request.args.get('page', 1, type=int))
+    query = request.args.get('q', '')
+    total, hits = message_search.indexer.search(
+        current_user.chats, query, (page - 1) * limit, limit
+    )
+    return jsonify(total=total, page=page, hits=hits), status.HTTP_200_OK
+
+
+def usernames_of(user_ids) -> list[dict]:
+    """Gets the ids and usernames of users, sorted by username"""
+    users = User.load_many(list(user_ids))
+    return sorted(
+        ({"id": user.get_id(), "username": user.username} for user in users),
+        key=lambda user: user["username"].lower(),
+    )
+
+
+@app.get('/friends')
+@login_required
+def friends_page():
+    """Friends, requests and suggestions"""
+    user_id = current_user.get_id()
+    friend_list = usernames_of(friends.friends(user_id))
+    return render_template(
+        'friends.html',
+        friends=friend_list,
+        online=tracker.online([friend["id"] for friend in friend_list]),
+        pending=usernames_of(friends.pending(user_id)),
+        sent=usernames_of(friends.sent(user_id)),
+        suggestions=usernames_of(friends.suggestions(user_id, FRIEND_SUGGESTIONS)),
+    )
+
+
+@app.post('/friends/request')
+@login_required
+@limit_route(*FRIEND_LIMITS)
+def request_friend():
+    """Sends a friend request to the user with the handle in the form"""
+    user_obj = get_user_from_handle(request.form.get('handle', ''))
+    if user_obj is None:
+        flash('Unable to find user', category="error")
+        return redirect(url_for('friends_page'))
+    result = friends.request(current_user.get_id(), user_obj.get_id())
+    message, category = FRIEND_REQUEST_RESULTS[result]
+    flash(message, category=category)
+    return redirect(url_for('friends_page'))
+
+
+@app.post('/friends/<user_id>/accept')
+@login_required
+def accept_friend(user_id):
+    """Accepts a friend request"""
+    if not friends.accept(current_user.get_id(), user_id):
+        flash('Friend request not found', category="error")
+    return redirect(url_for('friends_page'))
+
+
+@app.post('/friends/<user_id>/decline')
+@login_required
+def decline_friend(user_id):
+    """Declines a friend request"""
+    if not friends.decline(current_user.get_id(), user_id):
+        flash('Friend request not found', category="error")
+    return redirect(url_for('friends_page'))
+
+
+@app.post('/friends/<user_id>/remove')
+@login_required
+def remove_friend(user_id):
+    """Ends a friendship"""
+    friends.remove(current_user.get_id(), user_id)
+    return redirect(url_for('friends_page'))
+
+
+@app.get('/friends/<user_id>/mutual')
+@login_required
+def mutual_friends(user_id):
+    """Returns the friends the user has in common with one of their friends
+
+    Returns:
+        Response: JSON with the ids and usernames of the mutual friends
+    """
+    if not friends.are_friends(current_user.get_id(), user_id):
+        return jsonify(error="Friend not found"), status.HTTP_404_NOT_FOUND
+    mutual = friends.mutual(current_user.get_id(), user_id)
+    return jsonify(friends=usernames_of(mutual)), status.HTTP_200_OK
 
 
 @login_required
@@ -161,36 +529,30 @@ def create_chat():
     if 'handle' in request.form:
         handle = request.form['handle']
         user_obj = get_user_from_handle(handle)
+        if user_obj is None:
+            flash('Unable to find user', category="error")
+            return redirect(url_for('new_chat'))
         nbew_chat = Chat(
-            members=[user_obj,current_user],
+            members=[user_obj.get_id(), current_user.get_id()],
             chat_name=current_user.username+" and "+user_obj.username,
             messages=[],
         )
-        user_obj.chats.append(nbew_chat.get_id())
-        current_user.chats.append(nbew_chat.get_id())
-
-        # Add updated user to the database
-        user_obj.push_to_redis()
-        current_user.push_to_redis()
-
-        # Add chat to hashmap
-        nbew_chat.push_to_redis()
+        # Add the chat to both users and store it in one transaction
+        with UnitOfWork() as uow:
+            user_obj.add_chat(nbew_chat.get_id(), uow.pipe)
+            current_user.add_chat(nbew_chat.get_id(), uow.pipe)
+            nbew_chat.push_to_redis(uow.pipe)
         flash("Chat created", category="success")
-        return redirect(url_for('chat', chat=nbew_chat.get_id()))
+        return redirect(url_for('chat', chat_id=nbew_chat.get_id()))
     flash('Unable to find user', category="error")
     return redirect(url_for('home'))
 
 
 @app.post("/create_user")
+@limit_route(*SIGNUP_LIMITS)
 def create_user():
     """The create user response
     """
-    app.logger.info(
-        'Client %s connected to %s using method %s',
-        request.remote_addr,
-        request.path,
-        request.method
-    )
     if 'name' in request.form and 'email' in request.form and\
           'username' in request.form and 'password' in request.form:
         # New User
@@ -204,16 +566,11 @@ def create_user():
         # Next redirect
         next_arg = request.form.get('next')
 
-        # Checks if user exists
-        if r.hexists('usernames', new_user.username) == 1:
+        # Claims the username and adds the user to redis atomically
+        if not new_user.create():
             flash('User already exsists', category="error")
             return redirect(url_for('signup')), 302
 
-        # Added user to redis
-        new_user.push_to_redis()
-
-        r.hset(name='usernames',key=new_user.username, value=new_user.get_id())
-
         # Logs in user
         login_user(new_user)
 
@@ -223,14 +580,9 @@ def create_user():
 
 
 @app.post('/login')
+@limit_route(*LOGIN_LIMITS)
 def login():
     """Logs in user"""
-    app.logger.info(
-        'Client %s connected to %s using method %s',
-        request.remote_addr,
-        request.path,
-        request.method
-    )
     if 'username' in request.form and 'password' in request.form:
 
         # User info
@@ -247,8 +599,10 @@ def login():
             return redirect(back_ref or url_for('login_page'))
 
         # Gets user object
-        user = User()
-        user.pull_from_redis(user_id)
+        user = User.load(user_id)
+        if user is None:
+            flash('Username or Password is incorrect.', category='error')
+            return redirect('/login_page'), 302
 
 
         # Checks if passwords match
@@ -256,6 +610,13 @@ def login():
             flash('Username or Password is incorrect.', category='error')
             return redirect('/login_page'), 302
 
+        # Moves old hashes to the current hashing parameters
+        if user.upgrade_password(password):
+            try:
+                user.update(password=user.password)
+            except ConflictError:
+                # Changed meanwhile, the next login retries
+                app.logger.info('Skipped rehashing user %s, it changed', user_id)
 
 
         # Login user
@@ -276,12 +637,6 @@ def logout():
     Returns:
         Response: 302
     """
-    app.logger.info(
-        'Client %s connected to %s using method %s',
-        request.remote_addr,
-        request.path,
-        request.method
-    )
     logout_user()
     return redirect(url_for('index')), 302
 
@@ -289,9 +644,11 @@ def logout():
 def load_user_from_id(user_id):
     """Loads user from id for login_manager"""
 
-    # Empty user object
-    user = User()
-
-    user.pull_from_redis(user_id)
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
 
+    user = User.load(user_id)
+    if user is not None:
+        user_cache.put(user_id, user)
     return user
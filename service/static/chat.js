@@ -0,0 +1,104 @@
+document.addEventListener("DOMContentLoaded", function(){
+    let history = document.getElementById("history");
+    if(history === null){
+        return;
+    }
+    let chatId = history.dataset.chatId;
+    let list = document.getElementById("messages");
+    let form = document.getElementById("message-form");
+    let input = document.getElementById("message-input");
+    let socket = openSocket();
+    watchPresence(socket);
+
+    let ackTimer = null;
+    // One resume at a time, a gap seen meanwhile asks for another
+    let resuming = false;
+    let resumeAgain = false;
+
+    function showMessage(message){
+        if(newestMessage !== null && message.seq !== undefined && newestMessage.seq !== undefined){
+            if(message.seq <= newestMessage.seq){
+                // Already shown, e.g. replayed and delivered live
+                return;
+            }
+            if(message.seq > newestMessage.seq + 1){
+                // Missed messages in between, fetch them first
+                resume();
+                return;
+            }
+        }
+        if(!markShown(message)){
+            return;
+        }
+        let atBottom = history.scrollTop + history.clientHeight >= history.scrollHeight - 4;
+        list.appendChild(renderMessage(message));
+        newestMessage = message;
+        if(atBottom){
+            history.scrollTop = history.scrollHeight;
+        }
+        scheduleAck();
+    }
+
+    // Acks at most once a second rather than per message
+    function scheduleAck(){
+        if(ackTimer !== null){
+            return;
+        }
+        ackTimer = setTimeout(function(){
+            ackTimer = null;
+            socket.emit("ack", {chat_id: chatId, cursor: newestMessage.cursor});
+            if(document.visibilityState === "visible"){
+                socket.emit("read", {chat_id: chatId});
+            }
+        }, 1000);
+    }
+
+    // Replays this chat only, from the newest message shown or the last ack
+    function resume(){
+        if(resuming){
+            resumeAgain = true;
+            return;
+        }
+        resuming = true;
+        resumeAgain = false;
+        let cursors = {};
+        cursors[chatId] = newestMessage === null ? null : newestMessage.cursor;
+        socket.emit("resume", {cursors: cursors});
+    }
+
+    // Fires again after every reconnect
+    socket.on("connect", function(){
+        // A resume lost with the old connection will never be answered
+        resuming = false;
+        resume();
+    });
+
+    socket.on("chat_replay", function(batch){
+        if(batch.chat_id !== chatId){
+            return;
+        }
+        resuming = false;
+        for(let message of batch.messages){
+            showMessage(message);
+        }
+        if(!batch.complete || resumeAgain){
+            resume();
+        }
+    });
+
+    socket.on("chat_message", function(message){
+        if(message.chat_id !== chatId){
+            return;
+        }
+        showMessage(message);
+    });
+
+    form.addEventListener("submit", function(event){
+        event.preventDefault();
+        if(input.value === ""){
+            return;
+        }
+        socket.emit("message", {chat_id: chatId, content: input.value});
+        input.value = "";
+    });
+});
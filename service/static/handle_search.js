@@ -0,0 +1,41 @@
+const HANDLE_SEARCH_DELAY_MS = 150;
+
+let handleSearchTimer = null;
+let handleSearchController = null;
+
+async function suggestHandles(query){
+    if(handleSearchController !== null){
+        handleSearchController.abort();
+    }
+    handleSearchController = new AbortController();
+    let suggestions = document.getElementById("handle-suggestions");
+    try{
+        let response = await fetch(`/users/search?${new URLSearchParams({q: query})}`,
+                                   {signal: handleSearchController.signal});
+        if(!response.ok){
+            return;
+        }
+        let result = await response.json();
+        suggestions.replaceChildren(...result.users.map(function(username){
+            let option = document.createElement("option");
+            option.value = username;
+            return option;
+        }));
+    }catch(error){
+        if(error.name !== "AbortError"){
+            throw error;
+        }
+    }
+}
+
+document.addEventListener("DOMContentLoaded", function(){
+    let input = document.getElementById("handle");
+    input.addEventListener("input", function(){
+        clearTimeout(handleSearchTimer);
+        let query = input.value.trim();
+        if(query === ""){
+            return;
+        }
+        handleSearchTimer = setTimeout(() => suggestHandles(query), HANDLE_SEARCH_DELAY_MS);
+    });
+});
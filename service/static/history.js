@@ -0,0 +1,82 @@
+const HISTORY_PAGE_SIZE = 50;
+
+let historyCursor = null;
+let historyDone = false;
+let historyLoading = false;
+// Newest message shown, live messages and replays continue from it
+let newestMessage = null;
+// Ids of the messages shown, history pages and replays can overlap
+let shownMessages = new Set();
+
+// Records a message as shown, false if it already was
+function markShown(message){
+    if(message.id === undefined){
+        return true;
+    }
+    if(shownMessages.has(message.id)){
+        return false;
+    }
+    shownMessages.add(message.id);
+    return true;
+}
+
+function renderMessage(message){
+    let item = document.createElement("li");
+    item.dataset.cursor = message.cursor;
+    item.className = "rounded-lg bg-gray-100 dark:bg-gray-700 px-3 py-2 text-gray-900 dark:text-white";
+    item.textContent = message.content;
+    return item;
+}
+
+async function loadOlderMessages(){
+    if(historyLoading || historyDone){
+        return;
+    }
+    historyLoading = true;
+    let history = document.getElementById("history");
+    let list = document.getElementById("messages");
+    let params = new URLSearchParams({limit: HISTORY_PAGE_SIZE});
+    if(historyCursor !== null){
+        params.set("before", historyCursor);
+    }
+    try{
+        let response = await fetch(`/chats/${history.dataset.chatId}/messages?${params}`);
+        if(!response.ok){
+            historyDone = true;
+            return;
+        }
+        let page = await response.json();
+        if(newestMessage === null && page.messages.length > 0){
+            newestMessage = page.messages[page.messages.length - 1];
+        }
+        let previousHeight = history.scrollHeight;
+        let fragment = document.createDocumentFragment();
+        for(let message of page.messages){
+            if(markShown(message)){
+                fragment.appendChild(renderMessage(message));
+            }
+        }
+        list.prepend(fragment);
+        // Keep the viewport anchored on the message the user was reading
+        history.scrollTop += history.scrollHeight - previousHeight;
+        historyCursor = page.next_cursor;
+        historyDone = page.next_cursor === null;
+    }finally{
+        historyLoading = false;
+    }
+}
+
+document.addEventListener("DOMContentLoaded", async function(){
+    let history = document.getElementById("history");
+    if(history === null){
+        return;
+    }
+    await loadOlderMessages();
+    history.scrollTop = history.scrollHeight;
+    let observer = new IntersectionObserver(function(entries){
+        if(entries.some(entry => entry.isIntersecting)){
+            loadOlderMessages();
+        }
+    }, {root: history});
+    observer.observe(document.getElementById("history-sentinel"));
+});
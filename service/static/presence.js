@@ -0,0 +1,22 @@
+// Keeps the user marked online and [data-presence] indicators current
+function watchPresence(socket){
+    // Well within the server's timeout
+    setInterval(() => socket.emit("heartbeat"), 25000);
+
+    socket.on("presence", function(changes){
+        for(let change of changes){
+            for(let element of document.querySelectorAll(`[data-presence="${change.user_id}"]`)){
+                element.dataset.status = change.status;
+                element.title = change.status;
+            }
+        }
+    });
+}
+
+document.addEventListener("DOMContentLoaded", function(){
+    // The chat page shares its own socket, see chat.js
+    if(document.getElementById("history") !== null || document.querySelector("[data-presence]") === null){
+        return;
+    }
+    watchPresence(openSocket());
+});
@@ -0,0 +1,15 @@
+// Opens the Socket.IO connection and unpacks the server's batches
+function openSocket(){
+    // Websocket-only so reconnects need no sticky sessions across workers
+    let socket = io({transports: ["websocket"]});
+
+    // The server coalesces events into one frame of [event, ...args] entries
+    socket.on("batch", function(events){
+        for(let [event, ...args] of events){
+            for(let listener of socket.listeners(event)){
+                listener(...args);
+            }
+        }
+    });
+    return socket;
+}
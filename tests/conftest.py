@@ -0,0 +1,26 @@
+"""
+Test fixtures
+"""
+import fakeredis
+import pytest
+import redis
+
+from service.common import redis_data
+
+# Renamed in fakeredis 2.3x, the old name warns
+CONNECTION_CLASS = getattr(fakeredis, "FakeRedisConnection", fakeredis.FakeConnection)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Points the shared redis clients at an empty in-memory server"""
+    server = fakeredis.FakeServer()
+    for client in (redis_data.r, redis_data.rb):
+        kwargs = client.connection_pool.connection_kwargs
+        pool = redis.ConnectionPool(
+            connection_class=CONNECTION_CLASS,
+            server=server,
+            decode_responses=kwargs.get("decode_responses", False),
+        )
+        monkeypatch.setattr(client, "connection_pool", pool)
+    return redis_data.r
@@ -0,0 +1,18 @@
+"""
+Log handler tests
+"""
+import logging
+
+from flask import Flask
+
+from service.common import log_handlers
+
+
+def test_records_reach_stderr_without_gunicorn_handlers(capsys):
+    """Under wsgi.py there are no gunicorn handlers, errors still get written"""
+    app = Flask(__name__)
+    assert not logging.getLogger("test.no_gunicorn").handlers
+    log_handlers.init_logging(app, "test.no_gunicorn")
+    app.logger.error("Request failed: boom")
+    log_handlers._stop_listener()  # pylint: disable=protected-access
+    assert "Request failed: boom" in capsys.readouterr().err
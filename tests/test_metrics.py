@@ -0,0 +1,38 @@
+"""
+Metrics tests
+"""
+import threading
+
+from service.common import metrics
+
+
+def test_finished_threads_fold_into_the_base_shard():
+    """Samples of finished threads are kept without keeping their shards"""
+    counter = metrics.Counter("test_thread_churn_total", "Thread churn test", ("kind",))
+    metrics.REGISTRY.remove(counter)
+
+    def record():
+        counter.inc(("x",))
+
+    threads = [threading.Thread(target=record) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    record()
+    assert counter.samples() == {("x",): 51}
+    assert len(counter._shards) == 1  # pylint: disable=protected-access
+
+
+def test_merge_labels_samples_by_worker():
+    """Gauges of several workers are reported side by side, not summed"""
+    snapshot = {
+        "queue_depth": {
+            "kind": "gauge", "help": "Queue depth", "labels": [], "buckets": [],
+            "samples": [[[], 3]],
+        }
+    }
+    merged = metrics.merge({"a:1": snapshot, "b:2": snapshot})
+    assert merged["queue_depth"]["labels"] == ["worker"]
+    assert merged["queue_depth"]["samples"] == {("a:1",): 3, ("b:2",): 3}
+    assert 'queue_depth{worker="b:2"} 3' in metrics.render(merged)
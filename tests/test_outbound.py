@@ -0,0 +1,133 @@
+"""
+Outbound dispatcher tests
+
+Run the dispatcher against a stand-in client manager that records the
+engine.io packets written to each socket.
+"""
+from socketio import packet
+
+from service.common.outbound import OutboundDispatcher
+
+
+class FakeQueue:
+    """engine.io's send queue, with a settable backlog"""
+
+    def __init__(self):
+        self.backlog = 0
+        self.on_read = None
+
+    def qsize(self):
+        if self.on_read is not None:
+            on_read, self.on_read = self.on_read, None
+            on_read()
+        return self.backlog
+
+
+class FakeSocket:
+    def __init__(self):
+        self.queue = FakeQueue()
+
+
+class FakeEngine:
+    def __init__(self):
+        self.sockets = {}
+
+
+class FakeServer:
+    """Records what each engine.io socket is sent and counts encodings"""
+
+    def __init__(self):
+        self.eio = FakeEngine()
+        self.sent = {}
+        self.encoded = 0
+
+    def packet_class(self, *args, **kwargs):
+        self.encoded += 1
+        return packet.Packet(*args, **kwargs)
+
+    def _send_eio_packet(self, eio_sid, eio_pkt):
+        decoded = packet.Packet(encoded_packet=eio_pkt.data)
+        self.sent.setdefault(eio_sid, []).append(decoded.data)
+
+    def disconnect(self, sid, namespace=None):
+        raise AssertionError(f"{sid} disconnected")
+
+
+class FakeManager:
+    """A room of sockets, each with its engine.io socket"""
+
+    def __init__(self, sids):
+        self.server = FakeServer()
+        self.sids = sids
+        for sid in sids:
+            self.server.eio.sockets["eio-" + sid] = FakeSocket()
+
+    def get_participants(self, namespace, room):
+        return [(sid, "eio-" + sid) for sid in self.sids]
+
+    def is_connected(self, sid, namespace):
+        return True
+
+
+def make_dispatcher(sids):
+    dispatcher = OutboundDispatcher()
+    dispatcher.manager = FakeManager(sids)
+    return dispatcher
+
+
+def test_held_events_keep_their_order():
+    """Events held for a backlog go out before the ones queued meanwhile"""
+    dispatcher = make_dispatcher(["a"])
+    queue = dispatcher.manager.server.eio.sockets["eio-a"].queue
+    dispatcher.enqueue("chat_message", [1], "/", room="chat")
+    queue.backlog = dispatcher.eio_high_water + 1
+    # Queued while the flush holds the first message back
+    queue.on_read = lambda: dispatcher.enqueue("chat_message", [2], "/", room="chat")
+    dispatcher.flush()
+    assert dispatcher.manager.server.sent == {}
+
+    queue.backlog = 0
+    dispatcher.flush()
+    assert dispatcher.manager.server.sent["eio-a"] == [
+        ["batch", [["chat_message", 1], ["chat_message", 2]]]
+    ]
+
+
+def test_room_is_encoded_once():
+    """Every socket of a room shares one encoding, single events and batches alike"""
+    dispatcher = make_dispatcher(["a", "b", "c"])
+    server = dispatcher.manager.server
+    dispatcher.enqueue("chat_message", [1], "/", room="chat")
+    dispatcher.flush()
+    assert server.encoded == 1
+
+    dispatcher.enqueue("chat_message", [2], "/", room="chat")
+    dispatcher.enqueue("chat_message", [3], "/", room="chat")
+    dispatcher.flush()
+    assert server.encoded == 2
+    for eio_sid in ("eio-a", "eio-b", "eio-c"):
+        assert server.sent[eio_sid] == [
+            ["chat_message", 1],
+            ["batch", [["chat_message", 2], ["chat_message", 3]]],
+        ]
+
+
+def test_held_events_count_against_the_queue():
+    """Droppable events are dropped first when held events overflow the queue"""
+    dispatcher = make_dispatcher(["a"])
+    dispatcher.max_queue = 3
+    queue = dispatcher.manager.server.eio.sockets["eio-a"].queue
+    dispatcher.enqueue("presence", ["x"], "/", room="chat")
+    dispatcher.enqueue("chat_message", [1], "/", room="chat")
+    queue.backlog = dispatcher.eio_high_water + 1
+    queue.on_read = lambda: [
+        dispatcher.enqueue("chat_message", [n], "/", room="chat") for n in (2, 3)
+    ]
+    dispatcher.flush()
+    assert dispatcher.dropped == 1
+
+    queue.backlog = 0
+    dispatcher.flush()
+    assert dispatcher.manager.server.sent["eio-a"] == [
+        ["batch", [["chat_message", 1], ["chat_message", 2], ["chat_message", 3]]]
+    ]
@@ -0,0 +1,23 @@
+"""
+Presence tests
+"""
+from service.common import presence
+
+
+def test_closing_a_swept_socket_keeps_the_user_online(fake_redis):
+    """A sweep can't leave a socket count that a later close drives to 0"""
+    tracker = presence.PresenceTracker()
+    tracker.connect("u", "old")
+    tracker.connect("u", "new")
+    fake_redis.zadd(presence.ONLINE, {"u": 0})
+    tracker.sweep()
+    assert tracker.take_changes() == {"u": "offline"}
+
+    tracker.heartbeat("u", "new")
+    assert tracker.take_changes() == {"u": "online"}
+    tracker.disconnect("u", "old")
+    assert tracker.online(["u"]) == {"u": True}
+
+    tracker.disconnect("u", "new")
+    assert tracker.online(["u"]) == {"u": False}
+    assert tracker.take_changes() == {"u": "offline"}
@@ -0,0 +1,23 @@
+"""
+Redis instrumentation tests
+"""
+from service.common import metrics
+
+
+def round_trips() -> dict:
+    return {
+        labels[0]: sum(sample[:-1])
+        for labels, sample in metrics.REDIS_COMMANDS.samples().items()
+    }
+
+
+def test_script_checks_of_a_pipeline_count_as_round_trips(fake_redis):
+    """A script queued on a pipeline costs a SCRIPT EXISTS before the batch"""
+    script = fake_redis.register_script("return redis.call('INCR', KEYS[1])")
+    before = round_trips()
+    pipe = fake_redis.pipeline(transaction=True)
+    script(keys=["counter"], client=pipe)
+    assert pipe.execute() == [1]
+    after = round_trips()
+    assert after["multi"] - before.get("multi", 0) == 1
+    assert after["script exists"] - before.get("script exists", 0) == 1
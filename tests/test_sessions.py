@@ -0,0 +1,50 @@
+"""
+Session tests
+"""
+from flask import Flask, session
+from flask_login import LoginManager, UserMixin, login_user, user_logged_in
+
+from service.common.sessions import RedisSessionInterface, regenerate_session
+
+
+class FakeUser(UserMixin):
+    id = "u"
+
+
+def make_app():
+    app = Flask(__name__)
+    app.secret_key = "test"
+    app.session_interface = RedisSessionInterface()
+    LoginManager(app).user_loader(lambda user_id: FakeUser())
+    user_logged_in.connect(regenerate_session, app)
+
+    @app.get("/visit")
+    def visit():
+        session["visited"] = True
+        return "ok"
+
+    @app.get("/login")
+    def login():
+        login_user(FakeUser())
+        return "ok"
+
+    return app
+
+
+def test_login_replaces_a_planted_session_id(fake_redis):
+    """The id a session had before login is deleted and not reused"""
+    client = make_app().test_client()
+    client.get("/visit")
+    planted = client.get_cookie("session").value
+    planted_keys = set(fake_redis.keys("sessions:*"))
+    assert len(planted_keys) == 1
+
+    client.get("/login")
+    assert client.get_cookie("session").value != planted
+    keys = set(fake_redis.keys("sessions:*"))
+    assert len(keys) == 1 and not keys & planted_keys
+
+    attacker = make_app().test_client()
+    attacker.set_cookie("session", planted)
+    with attacker.session_transaction() as stolen:
+        assert "_user_id" not in stolen